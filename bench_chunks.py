@@ -0,0 +1,166 @@
+import argparse
+import ctypes
+import io
+import os
+import struct
+import sys
+import time
+import tracemalloc
+
+from compressed_payload import (
+    COMPRESSED_HEADER_LENGTH,
+    CompressionTypes,
+    decompress_chunks,
+    libcompression,
+)
+
+
+def build_payload(size: int, chunk_size: int, compression: CompressionTypes) -> bytes:
+    """Builds a chunk-compressed payload of the given decompressed size."""
+    # Half random, half repeating, so that compression has something to do.
+    block = os.urandom(chunk_size // 2) + b"\x00" * (chunk_size - chunk_size // 2)
+
+    parts = []
+    for offset in range(0, size, chunk_size):
+        decompressed = block[0 : min(chunk_size, size - offset)]
+        compressed = decompressed
+        if compression != CompressionTypes.PASSTHROUGH:
+            destination = ctypes.create_string_buffer(chunk_size * 2)
+            compressed_length = libcompression.compression_encode_buffer(
+                destination,
+                len(destination),
+                decompressed,
+                len(decompressed),
+                None,
+                compression.get_compression_algorithm(),
+            )
+            compressed = destination[0:compressed_length]
+
+        parts.append(
+            struct.pack(
+                ">HIHH",
+                compression.value,
+                offset,
+                len(compressed),
+                len(decompressed),
+            )
+        )
+        parts.append(compressed)
+
+    return b"".join(parts)
+
+
+def decompress_chunks_by_copying(contents: bytes, chunk_size: int) -> bytes:
+    """Decompresses as this repository originally did, for comparison.
+
+    Our contents are copied into a BytesIO, from which each chunk is read as bytes
+    and decompressed into its own buffer. Each is then appended to a growing BytesIO,
+    whose contents are copied out by getvalue()."""
+    data = io.BytesIO(contents)
+    decompressed_data = io.BytesIO()
+
+    while True:
+        (
+            raw_compression_type,
+            _,
+            compressed_length,
+            decompressed_length,
+        ) = struct.unpack(">HIHH", data.read(COMPRESSED_HEADER_LENGTH))
+        compression_type = CompressionTypes(raw_compression_type)
+        compressed = data.read(compressed_length)
+
+        if compression_type == CompressionTypes.PASSTHROUGH:
+            decompressed = compressed
+        else:
+            decompressed_buf = ctypes.create_string_buffer(decompressed_length)
+            buffer_size = libcompression.compression_decode_buffer(
+                decompressed_buf,
+                decompressed_length,
+                compressed,
+                compressed_length,
+                None,
+                compression_type.get_compression_algorithm(),
+            )
+            decompressed = decompressed_buf[0:buffer_size]
+        decompressed_data.write(decompressed)
+
+        if len(decompressed) != chunk_size:
+            break
+
+    return decompressed_data.getvalue()
+
+
+def decompress(contents: bytes, chunk_size: int, preallocate: bool) -> bytes:
+    if preallocate:
+        return decompress_chunks(contents, chunk_size)
+    return decompress_chunks_by_copying(contents, chunk_size)
+
+
+def measure_time(contents: bytes, chunk_size: int, preallocate: bool) -> float:
+    """Returns the time taken for a decompression."""
+    start = time.perf_counter()
+    decompressed = decompress(contents, chunk_size, preallocate)
+    duration = time.perf_counter() - start
+
+    del decompressed
+    return duration
+
+
+def measure_peak(contents: bytes, chunk_size: int, preallocate: bool) -> int:
+    """Returns the peak traced allocations for a decompression.
+    Tracing slows allocations, so this is measured separately from time."""
+    tracemalloc.start()
+    decompressed = decompress(contents, chunk_size, preallocate)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    del decompressed
+    return peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compares chunk decompression into a preallocated output arena against the original copying approach."
+    )
+    parser.add_argument(
+        "--size",
+        help="Decompressed payload size, in MiB.",
+        type=int,
+        default=256,
+    )
+    parser.add_argument(
+        "--chunk-size",
+        help="Size of each decompressed chunk. Passthrough chunks cannot exceed 65535.",
+        type=int,
+        default=0x8000,
+    )
+    parser.add_argument(
+        "--compression",
+        help="Chunk compression to benchmark. Only passthrough is available beyond macOS.",
+        choices=[item.name.lower() for item in CompressionTypes],
+        default="passthrough",
+    )
+    parser.add_argument("--runs", help="How many times to run each mode.", type=int, default=3)
+    args = parser.parse_args()
+
+    compression = CompressionTypes[args.compression.upper()]
+    if compression != CompressionTypes.PASSTHROUGH and sys.platform != "darwin":
+        print("Compressed chunks require libcompression, only available on macOS.")
+        exit(1)
+
+    # Our final chunk must be shorter than our chunk size to terminate the payload.
+    size = args.size * 1024 * 1024 - 1
+    contents = build_payload(size, args.chunk_size, compression)
+    print(f"{args.size} MiB payload, {len(contents)} bytes compressed ({compression.name})")
+
+    for preallocate in [False, True]:
+        mode = "preallocated arena" if preallocate else "original copies"
+        duration = min(
+            measure_time(contents, args.chunk_size, preallocate)
+            for _ in range(args.runs)
+        )
+        peak = measure_peak(contents, args.chunk_size, preallocate)
+        print(
+            f"{mode:>20}: {duration:.3f}s ({size / duration / 1024 / 1024:.0f} MiB/s), "
+            f"peak allocations {peak / 1024 / 1024:.1f} MiB"
+        )
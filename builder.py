@@ -0,0 +1,274 @@
+import argparse
+import errno
+import io
+import os
+import struct
+from dataclasses import dataclass, field
+from typing import BinaryIO, Iterable, Optional, Union
+
+from plist_unarchiver import SomewhatKeyedArchiver
+
+# The lengths of our header and of each payload row, as SuperBinary expects.
+HEADER_LENGTH = 0x2C
+ROW_LENGTH = 0x28
+# All offsets and lengths within a SuperBinary are 32-bit.
+MAX_OFFSET = 0xFFFFFFFF
+# The size of each read when copying without copy_file_range.
+COPY_READ_SIZE = 1024 * 1024
+
+# A payload may be read from a file path, a buffer, a readable file,
+# or an iterable of buffers (i.e. a generator).
+PayloadSource = Union[str, os.PathLike, bytes, BinaryIO, Iterable[bytes]]
+
+
+def parse_version(version: str) -> tuple[int, int, int, int]:
+    """Parses a version such as '100.7916.1052884864.1'."""
+    components = tuple(int(component) for component in version.split("."))
+    assert len(components) == 4, "Versions must have four components!"
+    return components
+
+
+@dataclass
+class BuilderPayload(object):
+    """A payload to be written by SuperBinaryBuilder."""
+
+    # The tag representing this payload, i.e. 'FOTA'.
+    tag: bytes
+    # Where this payload's contents are read from.
+    source: PayloadSource = field(repr=False)
+    # Entries for this payload within the SuperBinary plist,
+    # such as "Payload Filepath" or "Payload MetaData".
+    plist_metadata: dict
+    # i.e. (100, 7916, 1052884864, 1). If None, that of the SuperBinary is used.
+    version: Optional[tuple[int, int, int, int]]
+    # Binary metadata held by this payload. This is typically empty.
+    metadata: bytes = field(repr=False)
+
+
+class SuperBinaryBuilder(object):
+    """Writes a SuperBinary from the given payloads.
+
+    Payloads are streamed to our output one at a time, so they are never
+    held in memory together. As payloads from iterables have no known length
+    until consumed, placeholder rows are written first and filled in at the end.
+    Our output must therefore be seekable."""
+
+    header_version: int
+    version: tuple[int, int, int, int]
+    # Additional top-level entries for our SuperBinary plist.
+    plist_metadata: dict
+    payloads: list[BuilderPayload]
+
+    def __init__(
+        self,
+        version: tuple[int, int, int, int],
+        header_version: int = 2,
+        plist_metadata: Optional[dict] = None,
+    ):
+        assert header_version in [2, 3], "Unknown version of SuperBinary!"
+        self.header_version = header_version
+        self.version = version
+        self.plist_metadata = plist_metadata or {}
+        self.payloads = []
+
+    def add_payload(
+        self,
+        tag: bytes,
+        source: PayloadSource,
+        plist_metadata: Optional[dict] = None,
+        version: Optional[tuple[int, int, int, int]] = None,
+        metadata: bytes = b"",
+    ) -> BuilderPayload:
+        """Adds a payload to be written, in order of addition."""
+        assert len(tag) == 4, "Invalid 4CC/magic passed!"
+        payload = BuilderPayload(tag, source, plist_metadata or {}, version, metadata)
+        self.payloads.append(payload)
+        return payload
+
+    def get_plist(self) -> bytes:
+        """Archives our SuperBinary plist, with one entry per payload row."""
+        payload_entries = [
+            {"Payload 4CC": payload.tag.decode("ascii"), **payload.plist_metadata}
+            for payload in self.payloads
+        ]
+        root_object = {
+            "SuperBinary FormatVersion": self.header_version,
+            **self.plist_metadata,
+            "SuperBinary Payloads": payload_entries,
+        }
+        return SomewhatKeyedArchiver().archive_root_object(root_object)
+
+    def write(self, output: Union[str, os.PathLike, BinaryIO]):
+        """Writes our SuperBinary to the given path or seekable file."""
+        if isinstance(output, (str, os.PathLike)):
+            with open(output, "wb") as output_file:
+                self.write(output_file)
+            return
+
+        start = output.tell()
+        rows_length = ROW_LENGTH * len(self.payloads)
+
+        # Reserve space for our header and rows.
+        output.write(b"\x00" * (HEADER_LENGTH + rows_length))
+
+        rows = []
+        for payload in self.payloads:
+            metadata_offset = output.tell() - start
+            output.write(payload.metadata)
+
+            payloads_offset = output.tell() - start
+            payloads_length = write_source(payload.source, output)
+            assert (
+                payloads_offset + payloads_length <= MAX_OFFSET
+            ), "SuperBinary payloads cannot exceed 4 GiB!"
+
+            rows.append(
+                struct.pack(
+                    ">I4sIIIIIIII",
+                    ROW_LENGTH,
+                    payload.tag,
+                    *(payload.version or self.version),
+                    metadata_offset,
+                    len(payload.metadata),
+                    payloads_offset,
+                    payloads_length,
+                )
+            )
+
+        # Our plist trails our payloads, past `binary_size`.
+        binary_size = output.tell() - start
+        output.write(self.get_plist())
+        end = output.tell()
+
+        # Now that all offsets are known, fill in our header and rows.
+        # Our header's metadata has been observed to be empty.
+        output.seek(start)
+        output.write(
+            struct.pack(
+                ">IIIIIIIIIII",
+                self.header_version,
+                HEADER_LENGTH,
+                binary_size,
+                *self.version,
+                0,
+                0,
+                HEADER_LENGTH,
+                rows_length,
+            )
+        )
+        output.write(b"".join(rows))
+        output.seek(end)
+
+
+def write_source(source: PayloadSource, output: BinaryIO) -> int:
+    """Writes the given source to our output, returning its length."""
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as source_file:
+            return copy_file(source_file, output)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return output.write(source)
+    if hasattr(source, "read"):
+        return copy_file(source, output)
+
+    length = 0
+    for part in source:
+        length += output.write(part)
+    return length
+
+
+def copy_file(source: BinaryIO, output: BinaryIO) -> int:
+    """Copies the remainder of a file to our output.
+
+    Where possible, this is done via copy_file_range, allowing the kernel to
+    copy (or even share) data without it passing through our process."""
+    try:
+        source_fd = source.fileno()
+        output_fd = output.fileno()
+        source_size = os.fstat(source_fd).st_size
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return copy_file_object(source, output)
+
+    if not hasattr(os, "copy_file_range"):
+        return copy_file_object(source, output)
+
+    # Ensure buffered writes precede ours.
+    output.flush()
+    source_offset = source.tell()
+    output_offset = output.tell()
+    copied = 0
+    while source_offset + copied < source_size:
+        try:
+            written = os.copy_file_range(
+                source_fd,
+                output_fd,
+                source_size - source_offset - copied,
+                source_offset + copied,
+                output_offset + copied,
+            )
+        except OSError as e:
+            # Some filesystems (or combinations thereof) are unsupported.
+            if copied == 0 and e.errno in [
+                errno.EXDEV,
+                errno.ENOSYS,
+                errno.EINVAL,
+                errno.EOPNOTSUPP,
+            ]:
+                return copy_file_object(source, output)
+            raise
+        if written == 0:
+            # Our source was truncated while copying.
+            break
+        copied += written
+
+    source.seek(source_offset + copied)
+    output.seek(output_offset + copied)
+    return copied
+
+
+def copy_file_object(source: BinaryIO, output: BinaryIO) -> int:
+    length = 0
+    while True:
+        contents = source.read(COPY_READ_SIZE)
+        if not contents:
+            return length
+        length += output.write(contents)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Builds a SuperBinary from files.")
+    parser.add_argument("output", help="The SuperBinary to write.")
+    parser.add_argument(
+        "payloads",
+        help="Payloads to include, as TAG=path (i.e. FOTA=fota.bin), in order.",
+        nargs="+",
+    )
+    parser.add_argument(
+        "--version",
+        help="The version of this SuperBinary and its payloads.",
+        type=parse_version,
+        default=(1, 0, 0, 0),
+    )
+    parser.add_argument(
+        "--chunk-size",
+        help="Marks payloads as chunk-compressed with this chunk size, i.e. CHNK=4096. May be repeated.",
+        action="append",
+        default=[],
+    )
+    args = parser.parse_args()
+
+    chunk_sizes = {}
+    for argument in args.chunk_size:
+        tag, chunk_size = argument.split("=", 1)
+        chunk_sizes[tag] = int(chunk_size)
+
+    builder = SuperBinaryBuilder(args.version)
+    for argument in args.payloads:
+        tag, path = argument.split("=", 1)
+        plist_metadata = {"Payload Filepath": os.path.basename(path)}
+        if tag in chunk_sizes:
+            plist_metadata["Payload MetaData"] = {
+                "Payload Compression ChunkSize": chunk_sizes[tag]
+            }
+        builder.add_payload(tag.encode("ascii"), path, plist_metadata)
+
+    builder.write(args.output)
@@ -0,0 +1,414 @@
+import argparse
+import hashlib
+import os
+import pathlib
+import sqlite3
+import time
+from typing import Iterable, Optional
+
+from fota_payload import FotaMetadata, FotaMetadataType
+from super_binary import SuperBinary
+from source import iterate_paths
+
+# How many files are indexed within a single transaction.
+BATCH_SIZE = 100
+# The size of each read while hashing files.
+HASH_READ_SIZE = 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    indexed_at REAL NOT NULL,
+    -- If parsing failed, its reason. All other metadata is then absent.
+    error TEXT,
+    header_version INTEGER,
+    major_version INTEGER,
+    minor_version INTEGER,
+    release_version INTEGER,
+    build_version INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS payloads (
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    payload_index INTEGER NOT NULL,
+    tag TEXT NOT NULL,
+    major_version INTEGER NOT NULL,
+    minor_version INTEGER NOT NULL,
+    release_version INTEGER NOT NULL,
+    build_version INTEGER NOT NULL,
+    metadata_offset INTEGER NOT NULL,
+    metadata_length INTEGER NOT NULL,
+    payloads_offset INTEGER NOT NULL,
+    payloads_length INTEGER NOT NULL,
+    filepath TEXT,
+    long_name TEXT,
+    compressed_chunk_size INTEGER,
+    sha256 TEXT NOT NULL,
+    PRIMARY KEY (file_id, payload_index)
+);
+
+CREATE TABLE IF NOT EXISTS fota (
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    payload_index INTEGER NOT NULL,
+    firmware_version TEXT,
+    chipset_name TEXT,
+    design_name TEXT,
+    PRIMARY KEY (file_id, payload_index)
+);
+
+CREATE TABLE IF NOT EXISTS fota_segments (
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    payload_index INTEGER NOT NULL,
+    segment_index INTEGER NOT NULL,
+    payload_offset INTEGER NOT NULL,
+    payload_length INTEGER NOT NULL,
+    unknown INTEGER NOT NULL,
+    PRIMARY KEY (file_id, payload_index, segment_index)
+);
+
+CREATE INDEX IF NOT EXISTS payloads_tag ON payloads(tag);
+CREATE INDEX IF NOT EXISTS payloads_sha256 ON payloads(sha256);
+CREATE INDEX IF NOT EXISTS files_sha256 ON files(sha256);
+"""
+
+
+def hash_file(path: pathlib.Path) -> str:
+    """Returns the SHA-256 digest of the file at the given path."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_READ_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_fota_string(metadata: FotaMetadata, data_type: FotaMetadataType) -> Optional[str]:
+    """Returns the string contents of the given FOTA metadata type, if present."""
+    current_object = metadata.all_metadata.get(data_type)
+    if current_object is None:
+        return None
+    return current_object.contents
+
+
+class Catalog(object):
+    """A persistent index of SuperBinaries, their payloads and FOTA metadata."""
+
+    connection: sqlite3.Connection
+
+    def __init__(self, database_path: pathlib.Path):
+        # Transactions are managed explicitly, so that indexing can be batched.
+        self.connection = sqlite3.connect(database_path, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def index(self, paths: Iterable[pathlib.Path]) -> dict[str, int]:
+        """Indexes the given files, skipping those that have not changed.
+
+        Returns counts of files that were "indexed", "unchanged" or "failed"."""
+        counts = {"indexed": 0, "unchanged": 0, "failed": 0}
+
+        pending = 0
+        self.connection.execute("BEGIN")
+        try:
+            for path in paths:
+                result = self.index_file(path)
+                counts[result] += 1
+
+                # Commit in bulk, rather than once per file.
+                pending += 1
+                if pending >= BATCH_SIZE:
+                    self.connection.execute("COMMIT")
+                    self.connection.execute("BEGIN")
+                    pending = 0
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+
+        return counts
+
+    def index_file(self, path: pathlib.Path) -> str:
+        """Indexes a single file. This must be called within a transaction.
+        Files which cannot be read (i.e. those removed while indexing) have failed."""
+        resolved_path = str(path.resolve())
+        try:
+            stat = path.stat()
+        except OSError:
+            return "failed"
+
+        existing = self.connection.execute(
+            "SELECT id, size, mtime_ns, sha256 FROM files WHERE path = ?",
+            (resolved_path,),
+        ).fetchone()
+
+        # Files with the same size and modification time are assumed unchanged.
+        if (
+            existing is not None
+            and existing["size"] == stat.st_size
+            and existing["mtime_ns"] == stat.st_mtime_ns
+        ):
+            return "unchanged"
+
+        # Otherwise, only re-parse if the contents have actually changed.
+        try:
+            sha256 = hash_file(path)
+        except OSError:
+            return "failed"
+        if existing is not None and existing["sha256"] == sha256:
+            self.connection.execute(
+                "UPDATE files SET size = ?, mtime_ns = ? WHERE id = ?",
+                (stat.st_size, stat.st_mtime_ns, existing["id"]),
+            )
+            return "unchanged"
+
+        if existing is not None:
+            # Payloads, FOTA metadata and segments cascade.
+            self.connection.execute("DELETE FROM files WHERE id = ?", (existing["id"],))
+
+        try:
+            with open(path, "rb") as f:
+                super_binary = SuperBinary(f)
+        except Exception as e:
+            self.connection.execute(
+                "INSERT INTO files (path, size, mtime_ns, sha256, indexed_at, error) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (resolved_path, stat.st_size, stat.st_mtime_ns, sha256, time.time(), repr(e)),
+            )
+            return "failed"
+
+        file_id = self.connection.execute(
+            "INSERT INTO files (path, size, mtime_ns, sha256, indexed_at, "
+            "header_version, major_version, minor_version, release_version, build_version) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                resolved_path,
+                stat.st_size,
+                stat.st_mtime_ns,
+                sha256,
+                time.time(),
+                super_binary.header_version,
+                super_binary.major_version,
+                super_binary.minor_version,
+                super_binary.release_version,
+                super_binary.build_version,
+            ),
+        ).lastrowid
+        self.insert_payloads(file_id, super_binary)
+        return "indexed"
+
+    def insert_payloads(self, file_id: int, super_binary: SuperBinary):
+        payload_rows = []
+        fota_rows = []
+        segment_rows = []
+
+        for payload_index, payload in enumerate(super_binary.payloads):
+            payload_rows.append(
+                (
+                    file_id,
+                    payload_index,
+                    payload.get_tag(),
+                    payload.major_version,
+                    payload.minor_version,
+                    payload.release_version,
+                    payload.build_version,
+                    payload.metadata_offset,
+                    payload.metadata_length,
+                    payload.payloads_offset,
+                    payload.payloads_length,
+                    payload.plist_metadata.filepath,
+                    payload.plist_metadata.long_name,
+                    payload.plist_metadata.compressed_chunk_size,
+                    hashlib.sha256(payload.contents).hexdigest(),
+                )
+            )
+
+            if payload.tag != b"FOTA":
+                continue
+
+            # Only FOTA metadata is parsed; its LZMA payload is left untouched.
+            try:
+                fota_metadata = FotaMetadata(payload.contents[0:0x1000])
+            except Exception:
+                continue
+
+            fota_rows.append(
+                (
+                    file_id,
+                    payload_index,
+                    get_fota_string(fota_metadata, FotaMetadataType.FIRMWARE_VERSION),
+                    get_fota_string(fota_metadata, FotaMetadataType.CHIPSET_NAME),
+                    get_fota_string(fota_metadata, FotaMetadataType.DESIGN_NAME),
+                )
+            )
+            for segment_index, segment in enumerate(fota_metadata.segments):
+                segment_rows.append(
+                    (
+                        file_id,
+                        payload_index,
+                        segment_index,
+                        segment.payload_offset,
+                        segment.payload_length,
+                        segment.unknown,
+                    )
+                )
+
+        self.connection.executemany(
+            "INSERT INTO payloads VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            payload_rows,
+        )
+        self.connection.executemany(
+            "INSERT INTO fota VALUES (?, ?, ?, ?, ?)",
+            fota_rows,
+        )
+        self.connection.executemany(
+            "INSERT INTO fota_segments VALUES (?, ?, ?, ?, ?, ?)",
+            segment_rows,
+        )
+
+    def prune(self) -> int:
+        """Removes files which no longer exist on disk. Returns the count removed."""
+        missing = [
+            (row["id"],)
+            for row in self.connection.execute("SELECT id, path FROM files")
+            if not os.path.exists(row["path"])
+        ]
+        self.connection.execute("BEGIN")
+        self.connection.executemany("DELETE FROM files WHERE id = ?", missing)
+        self.connection.execute("COMMIT")
+        return len(missing)
+
+    def find_tag(self, tag: str) -> list[sqlite3.Row]:
+        """Returns all payloads with the given tag, alongside their file."""
+        return self.connection.execute(
+            "SELECT files.path, files.major_version || '.' || files.minor_version || '.' "
+            "|| files.release_version || '.' || files.build_version AS version, "
+            "payloads.payload_index, payloads.tag, payloads.filepath, payloads.sha256 "
+            "FROM payloads JOIN files ON files.id = payloads.file_id "
+            "WHERE payloads.tag = ? ORDER BY files.path, payloads.payload_index",
+            (tag,),
+        ).fetchall()
+
+    def find_hash(self, sha256: str) -> list[sqlite3.Row]:
+        """Returns all files and payloads with the given SHA-256 digest."""
+        return self.connection.execute(
+            "SELECT files.path, NULL AS payload_index, NULL AS tag FROM files "
+            "WHERE files.sha256 = ? "
+            "UNION ALL "
+            "SELECT files.path, payloads.payload_index, payloads.tag "
+            "FROM payloads JOIN files ON files.id = payloads.file_id "
+            "WHERE payloads.sha256 = ? ORDER BY 1, 2",
+            (sha256.lower(), sha256.lower()),
+        ).fetchall()
+
+    def find_fota(
+        self,
+        firmware_version: Optional[str] = None,
+        chipset_name: Optional[str] = None,
+        design_name: Optional[str] = None,
+    ) -> list[sqlite3.Row]:
+        """Returns FOTA metadata matching all given fields."""
+        conditions = []
+        parameters = []
+        for column, value in [
+            ("fota.firmware_version", firmware_version),
+            ("fota.chipset_name", chipset_name),
+            ("fota.design_name", design_name),
+        ]:
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                parameters.append(value)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        return self.connection.execute(
+            "SELECT files.path, fota.firmware_version, fota.chipset_name, "
+            "fota.design_name, payloads.sha256, "
+            "(SELECT COUNT(*) FROM fota_segments WHERE fota_segments.file_id = fota.file_id "
+            "AND fota_segments.payload_index = fota.payload_index) AS segment_count "
+            "FROM fota JOIN files ON files.id = fota.file_id "
+            "JOIN payloads ON payloads.file_id = fota.file_id "
+            "AND payloads.payload_index = fota.payload_index "
+            f"{where} ORDER BY files.path",
+            parameters,
+        ).fetchall()
+
+
+def print_rows(rows: list[sqlite3.Row]):
+    """Prints query results as tab-separated values, with a header."""
+    if not rows:
+        print("No results.")
+        return
+
+    print("\t".join(rows[0].keys()))
+    for row in rows:
+        print("\t".join("" if value is None else str(value) for value in row))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Maintains and queries a catalog of SuperBinaries."
+    )
+    parser.add_argument(
+        "database",
+        help="Path to the SQLite catalog. It is created if not present.",
+        type=pathlib.Path,
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    index_parser = subparsers.add_parser(
+        "index", help="Index SuperBinaries, skipping unchanged files."
+    )
+    index_parser.add_argument(
+        "paths",
+        help="SuperBinaries, or directories containing them, to index.",
+        nargs="+",
+        type=pathlib.Path,
+    )
+    index_parser.add_argument(
+        "--prune",
+        help="Whether to remove files from the catalog that no longer exist.",
+        action=argparse.BooleanOptionalAction,
+    )
+
+    tag_parser = subparsers.add_parser("tag", help="Find payloads with a tag.")
+    tag_parser.add_argument("tag", help="The 4CC to search for, i.e. FOTA.")
+
+    hash_parser = subparsers.add_parser(
+        "hash", help="Find files or payloads with a SHA-256 digest."
+    )
+    hash_parser.add_argument("sha256", help="The hex digest to search for.")
+
+    fota_parser = subparsers.add_parser("fota", help="Find FOTA metadata.")
+    fota_parser.add_argument("--firmware-version")
+    fota_parser.add_argument("--chipset-name")
+    fota_parser.add_argument("--design-name")
+
+    args = parser.parse_args()
+    catalog = Catalog(args.database)
+
+    if args.command == "index":
+        counts = catalog.index(iterate_paths(args.paths))
+        print(
+            f"Indexed {counts['indexed']}, unchanged {counts['unchanged']}, "
+            f"failed {counts['failed']}."
+        )
+        if args.prune:
+            print(f"Pruned {catalog.prune()} missing files.")
+    elif args.command == "tag":
+        print_rows(catalog.find_tag(args.tag))
+    elif args.command == "hash":
+        print_rows(catalog.find_hash(args.sha256))
+    elif args.command == "fota":
+        print_rows(
+            catalog.find_fota(
+                args.firmware_version, args.chipset_name, args.design_name
+            )
+        )
+
+    catalog.close()
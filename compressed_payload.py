@@ -1,10 +1,12 @@
 from dataclasses import dataclass, field
 from enum import Enum
-from io import BytesIO
+from typing import Iterator, Optional
 import ctypes
 import struct
 import sys
 
+from events import ChunkProgress, EventEmitter
+from memory import MemoryBudget
 from uarp_payload import UarpPayload
 
 # TODO(spotlightishere): Replace libcompression.dylib with a cross-platform implementation
@@ -57,12 +59,14 @@ class CompressionTypes(Enum):
 class CompressedChunk(object):
     """Parses and decompresses a chunk of a compressed payload."""
 
+    # Offset of this chunk's header within the compressed payload.
+    offset: int
+
     # Compression type - the only observed value is LZBitmapFast2.
     # (However, this appears to match with CoreUARP's handling of such.)
     raw_compression_type: int
 
     # Offset of this chunk within the decompressed file.
-    # We can't use this.
     decompressed_offset: int
 
     # Amount of compressed data within this chunk.
@@ -75,16 +79,18 @@ class CompressedChunk(object):
     decompressed_length: int
 
     # Our raw data to decompress.
-    compressed_data: bytes = field(repr=False)
+    compressed_data: memoryview = field(repr=False)
+
+    def __init__(self, raw_data: memoryview, offset: int):
+        self.offset = offset
 
-    def __init__(self, raw_data: BytesIO):
         # Parse the current chunk's metadata. This is seemingly always big endian.
         (
             raw_compression_type,
             self.decompressed_offset,
             self.compressed_length,
             self.decompressed_length,
-        ) = struct.unpack_from(">HIHH", raw_data.read(COMPRESSED_HEADER_LENGTH))
+        ) = struct.unpack_from(">HIHH", raw_data, offset)
         self.compression_type = CompressionTypes(raw_compression_type)
 
         # Passthrough chunks must have the same length for compressed and decompressed data.
@@ -94,7 +100,8 @@ class CompressedChunk(object):
             ), "Invalid passthrough chunk lengths!"
 
         # Our raw data is immediately beyond our header.
-        self.compressed_data = raw_data.read(self.compressed_length)
+        data_offset = offset + COMPRESSED_HEADER_LENGTH
+        self.compressed_data = raw_data[data_offset : data_offset + self.compressed_length]
 
     def decompress(self) -> bytes:
         """Leverages libcompression from macOS to decompress contents."""
@@ -110,46 +117,226 @@ class CompressedChunk(object):
         buffer_size = libcompression.compression_decode_buffer(
             decompressed_buf,
             self.decompressed_length,
-            self.compressed_data,
+            bytes(self.compressed_data),
             self.compressed_length,
             None,
             compression_algorithm,
         )
         return decompressed_buf[0:buffer_size]
 
+    def decompress_into(self, destination: memoryview) -> int:
+        """Decompresses directly into the given writable buffer, without
+        intermediate copies. Returns the amount of data written."""
+        if self.compression_type == CompressionTypes.PASSTHROUGH:
+            destination[0 : self.compressed_length] = self.compressed_data
+            return self.compressed_length
 
-def decompress_payload_chunks(payload: UarpPayload) -> bytes:
-    """Decompresses a compressed payload within a SuperBinary."""
+        compression_algorithm = self.compression_type.get_compression_algorithm()
+
+        # libcompression writes directly into our destination's memory.
+        destination_buf = (ctypes.c_char * len(destination)).from_buffer(destination)
+        return libcompression.compression_decode_buffer(
+            destination_buf,
+            len(destination),
+            bytes(self.compressed_data),
+            self.compressed_length,
+            None,
+            compression_algorithm,
+        )
+
+
+class ChunkErrorKind(Enum):
+    """Structural problems found while walking chunks."""
+
+    OUT_OF_BOUNDS = "out-of-bounds"
+    UNKNOWN_COMPRESSION_TYPE = "unknown-compression-type"
+    INVALID_PASSTHROUGH = "invalid-passthrough"
+    DISCONTIGUOUS = "discontiguous"
+
+
+class ChunkError(AssertionError):
+    """A structural problem within chunked contents, at the given offset."""
 
-    data = BytesIO(payload.contents)
-    decompressed_data = BytesIO()
+    def __init__(self, kind: ChunkErrorKind, message: str, offset: int):
+        super().__init__(message)
+        self.kind = kind
+        self.offset = offset
 
-    # We're not presented with the resulting size of this content.
+
+@dataclass
+class ChunkHeader(object):
+    """The header of a chunk, as found by `walk_chunks`."""
+
+    # Offset of this header within the compressed payload.
+    offset: int
+    compression_type: CompressionTypes
+    # Offset of this chunk within the decompressed file.
+    decompressed_offset: int
+    compressed_length: int
+    decompressed_length: int
+
+    @property
+    def end(self) -> int:
+        """The offset immediately following this chunk's data."""
+        return self.offset + COMPRESSED_HEADER_LENGTH + self.compressed_length
+
+
+def walk_chunks(contents: bytes, chunk_size: Optional[int]) -> Iterator[ChunkHeader]:
+    """Yields the header of each chunk within chunked contents.
+    If no chunk size is given, that of our first chunk is assumed.
+
+    Only headers are read, via slicing, so contents may be any sized object
+    that can be sliced. Raises ChunkError should a chunk be of an unknown type,
+    not follow its predecessor, or extend past our contents."""
+    offset = 0
+    expected_offset = 0
+
+    # We're not presented with the count of chunks within this content.
     # As such, we'll need to iterate through this entire file, handling chunks as we go.
     while True:
-        # Read and decompress the current chunk.
-        current_chunk = CompressedChunk(data)
-        decompressed = current_chunk.decompress()
+        if offset + COMPRESSED_HEADER_LENGTH > len(contents):
+            raise ChunkError(
+                ChunkErrorKind.OUT_OF_BOUNDS,
+                "Chunk header extends past payload end!",
+                offset,
+            )
 
-        # Ensure we've fully decompressed this data as expected.
-        expected_length = current_chunk.decompressed_length
-        actual_length = len(decompressed)
+        # This is seemingly always big endian.
+        (
+            raw_compression_type,
+            decompressed_offset,
+            compressed_length,
+            decompressed_length,
+        ) = struct.unpack(">HIHH", contents[offset : offset + COMPRESSED_HEADER_LENGTH])
+        try:
+            compression_type = CompressionTypes(raw_compression_type)
+        except ValueError:
+            raise ChunkError(
+                ChunkErrorKind.UNKNOWN_COMPRESSION_TYPE,
+                f"Unknown compression type {raw_compression_type}!",
+                offset,
+            ) from None
 
-        if expected_length != actual_length:
-            # We need to step back by this current chunk's size in order to get its starting offset.
-            chunk_offset = (
-                data.tell() - current_chunk.compressed_length - COMPRESSED_HEADER_LENGTH
+        # Passthrough chunks must have the same length for compressed and decompressed data.
+        if (
+            compression_type == CompressionTypes.PASSTHROUGH
+            and compressed_length != decompressed_length
+        ):
+            raise ChunkError(
+                ChunkErrorKind.INVALID_PASSTHROUGH,
+                "Invalid passthrough chunk lengths!",
+                offset,
             )
-            raise AssertionError(
-                "Data did not fully decompress! "
-                f"(chunk offset {chunk_offset}; expected {expected_length}, but only read {actual_length})"
+
+        # Chunks must follow one another, so that we leave no gaps.
+        if decompressed_offset != expected_offset:
+            raise ChunkError(
+                ChunkErrorKind.DISCONTIGUOUS,
+                "Chunk is not contiguous with its predecessor! "
+                f"(expected decompressed offset {expected_offset:#x}, but found {decompressed_offset:#x})",
+                offset,
             )
 
-        decompressed_data.write(decompressed)
+        header = ChunkHeader(
+            offset,
+            compression_type,
+            decompressed_offset,
+            compressed_length,
+            decompressed_length,
+        )
+        if header.end > len(contents):
+            raise ChunkError(
+                ChunkErrorKind.OUT_OF_BOUNDS,
+                "Chunk data extends past payload end!",
+                offset + COMPRESSED_HEADER_LENGTH,
+            )
+        yield header
 
         # If we have a block size that decompresses to less than the chunk size
         # as specified in metadata, then we've come to an end of our chunks.
-        if len(decompressed) != payload.plist_metadata.compressed_chunk_size:
-            break
+        if chunk_size is None:
+            chunk_size = decompressed_length
+        if decompressed_length != chunk_size:
+            return
+
+        offset = header.end
+        expected_offset += decompressed_length
+
+
+def read_chunks(contents: bytes, chunk_size: int) -> list[CompressedChunk]:
+    """Walks the chunk headers of compressed contents, without decompressing."""
+    data = memoryview(contents)
+    return [
+        CompressedChunk(data, header.offset) for header in walk_chunks(data, chunk_size)
+    ]
+
+
+def decompress_chunks(
+    contents: bytes,
+    chunk_size: int,
+    budget: Optional[MemoryBudget] = None,
+    events: Optional[EventEmitter] = None,
+    item: str = "payload",
+) -> memoryview:
+    """Decompresses chunked contents with the given chunk size.
+
+    Our output is sized once from the chunk table, and each chunk
+    is decompressed directly into its slice of it.
+
+    If a memory budget is given and our output does not fit within it, decompressed
+    contents are held within a temporary file and returned as a mapped view.
+    Progress events are reported under the given item name."""
 
-    return decompressed_data.getvalue()
+    if budget is None:
+        budget = MemoryBudget()
+
+    # Chunks are validated as they are read: they must be contiguous, within
+    # our contents, and end with a short chunk. Only then do we allocate.
+    chunks = read_chunks(contents, chunk_size)
+    # Passthrough chunks can be handled anywhere; others require libcompression.
+    # TODO(spotlightishere): This should function on platforms beyond macOS.
+    if libcompression is None and any(
+        chunk.compression_type != CompressionTypes.PASSTHROUGH for chunk in chunks
+    ):
+        raise AssertionError("Decompression is not yet supported on this platform.")
+
+    # Our final chunk specifies where our decompressed contents end.
+    last_chunk = chunks[-1]
+    total_length = last_chunk.decompressed_offset + last_chunk.decompressed_length
+    arena = budget.arena(total_length)
+
+    for chunk_num, current_chunk in enumerate(chunks):
+        chunk_start = current_chunk.decompressed_offset
+        chunk_end = chunk_start + current_chunk.decompressed_length
+
+        expected_length = current_chunk.decompressed_length
+        actual_length = current_chunk.decompress_into(arena[chunk_start:chunk_end])
+        if expected_length != actual_length:
+            raise AssertionError(
+                "Data did not fully decompress! "
+                f"(chunk offset {current_chunk.offset}; expected {expected_length}, but only read {actual_length})"
+            )
+
+        if events is not None:
+            events.progress(
+                ChunkProgress(item, chunk_num + 1, len(chunks), chunk_end),
+                f"chunks:{id(contents)}",
+                final=chunk_num + 1 == len(chunks),
+            )
+
+    return arena
+
+
+def decompress_payload_chunks(
+    payload: UarpPayload,
+    budget: Optional[MemoryBudget] = None,
+    events: Optional[EventEmitter] = None,
+) -> memoryview:
+    """Decompresses a compressed payload within a SuperBinary."""
+    return decompress_chunks(
+        payload.contents,
+        payload.plist_metadata.compressed_chunk_size,
+        budget,
+        events,
+        payload.get_tag(),
+    )
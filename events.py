@@ -0,0 +1,143 @@
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Callable, Optional, TextIO
+
+# Progress events for the same item are emitted at most this often, in seconds.
+DEFAULT_PROGRESS_INTERVAL = 0.5
+
+
+@dataclass
+class Event(object):
+    """Base class for all events. Its subclasses' names are their event types."""
+
+    # When this event occurred, as a UNIX timestamp.
+    timestamp: float = field(default_factory=time.time, init=False)
+
+    def to_dict(self) -> dict:
+        """Returns a JSON-serializable representation of this event."""
+        return {"event": type(self).__name__, **asdict(self)}
+
+
+@dataclass
+class StageStarted(Event):
+    """A stage of extraction has begun, i.e. "decompress_fota"."""
+
+    stage: str
+    # The item this stage operates on, if any (such as a payload tag).
+    item: Optional[str] = None
+
+
+@dataclass
+class StageFinished(Event):
+    """A stage of extraction has completed."""
+
+    stage: str
+    item: Optional[str] = None
+    # How long this stage took, in seconds.
+    duration: float = 0.0
+    # If this stage failed, a description of its exception.
+    error: Optional[str] = None
+
+
+@dataclass
+class PayloadFound(Event):
+    """A payload was found within a SuperBinary."""
+
+    tag: str
+    index: int
+    filepath: Optional[str]
+    length: int
+    # Whether this payload's contents were read.
+    selected: bool
+
+
+@dataclass
+class DecodeProgress(Event):
+    """Bytes decoded so far for a stream, i.e. LZMA decompression of a FOTA."""
+
+    item: str
+    decoded_bytes: int
+    # The total size to decode, if known ahead of time.
+    total_bytes: Optional[int] = None
+
+
+@dataclass
+class ChunkProgress(Event):
+    """A chunk of a compressed payload was decompressed."""
+
+    item: str
+    # The 1-based index of the chunk just decompressed.
+    chunk: int
+    total_chunks: int
+    decoded_bytes: int
+
+
+@dataclass
+class FileWritten(Event):
+    """An output was written."""
+
+    file_name: str
+    size: int
+    # How long writing took, in seconds.
+    duration: float
+
+
+class EventEmitter(object):
+    """Delivers events to a callback, which may be invoked from any thread.
+
+    Progress events are rate limited: for each item, at most one is delivered
+    per interval, though final progress is always delivered."""
+
+    def __init__(
+        self,
+        callback: Callable[[Event], None],
+        progress_interval: float = DEFAULT_PROGRESS_INTERVAL,
+    ):
+        self.callback = callback
+        self.progress_interval = progress_interval
+        self.lock = threading.Lock()
+        # When progress was last delivered, keyed by item.
+        self.last_progress: dict[str, float] = {}
+
+    def emit(self, event: Event):
+        with self.lock:
+            self.callback(event)
+
+    def progress(self, event: Event, item: str, final: bool = False):
+        """Emits a progress event, unless one was recently emitted for this item."""
+        now = time.monotonic()
+        with self.lock:
+            last = self.last_progress.get(item)
+            if not final and last is not None and now - last < self.progress_interval:
+                return
+            self.last_progress[item] = now
+            self.callback(event)
+
+    @contextmanager
+    def stage(self, stage: str, item: Optional[str] = None):
+        """Emits events surrounding a stage of work.
+        Stages which raise are finished with their error, which is then re-raised."""
+        start = time.monotonic()
+        self.emit(StageStarted(stage, item))
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            self.emit(StageFinished(stage, item, time.monotonic() - start, error))
+
+
+def jsonl_writer(stream: TextIO = sys.stdout) -> Callable[[Event], None]:
+    """Returns a callback writing events as JSON lines, flushing each line."""
+
+    def write_event(event: Event):
+        stream.write(json.dumps(event.to_dict()) + "\n")
+        stream.flush()
+
+    return write_event
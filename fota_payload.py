@@ -1,8 +1,70 @@
-import io
 import lzma
 import struct
 from dataclasses import dataclass, field
 from enum import IntEnum
+from functools import cached_property
+from typing import Iterator, Optional
+
+from events import DecodeProgress, EventEmitter
+from memory import MemoryBudget
+
+# Decompression is streamed in portions of this size when memory is budgeted
+# or progress is reported.
+DECOMPRESS_READ_SIZE = 1024 * 1024
+# A declared size of all 0xFF bytes means the decompressed size is unknown.
+LZMA_UNKNOWN_SIZE = 0xFFFFFFFFFFFFFFFF
+
+
+def get_lzma_declared_size(compressed: bytes) -> Optional[int]:
+    """Returns the decompressed size declared by an LZMA alone ("legacy .lzma") header,
+    or None if not present or unknown."""
+    # Its header is 1 byte of properties (lc/lp/pb, which must be below 225),
+    # a 4 byte dictionary size, and then our decompressed size as a little endian u8.
+    if len(compressed) < 13 or compressed[0] >= 225:
+        return None
+    (declared_size,) = struct.unpack_from("<Q", compressed, 5)
+    if declared_size == LZMA_UNKNOWN_SIZE:
+        return None
+    return declared_size
+
+
+class FotaMetadataError(AssertionError):
+    """A structural problem within FOTA metadata, at the given offset."""
+
+    def __init__(self, message: str, offset: int):
+        super().__init__(message)
+        self.offset = offset
+
+
+def walk_fota_tlvs(raw_metadata: bytes) -> Iterator[tuple[int, int, memoryview]]:
+    """Yields the type, offset and contents of each TLV within FOTA metadata.
+    Contents are views, rather than copies."""
+    data = memoryview(raw_metadata)
+    # We begin with a 256-byte signature.
+    position = 256
+
+    while True:
+        # Following our signature, we have an array of TLV entries.
+        # Directly proceeding them is padding filled with 0xFF.
+        #
+        # There appears to be no count of the TLV fields, so we simply
+        # cease reading once we encounter a type of 0xFFFF.
+        if position + 4 > len(data):
+            raise FotaMetadataError(
+                "FOTA TLVs are not terminated within metadata!", position
+            )
+        (data_type, data_length) = struct.unpack_from("<HH", data, position)
+        if data_type == 0xFFFF:
+            # We've reached the end of possible TLV types.
+            return
+
+        value_end = position + 4 + data_length
+        if value_end > len(data):
+            raise FotaMetadataError(
+                f"TLV {data_type:#x} extends past FOTA metadata!", position
+            )
+        yield data_type, position, data[position + 4 : value_end]
+        position = value_end
 
 
 class FotaMetadataType(IntEnum):
@@ -30,8 +92,8 @@ class FotaString:
 
     contents: str
 
-    def __init__(self, binary_contents: bytes):
-        self.contents = binary_contents.decode("utf-8")
+    def __init__(self, binary_contents: memoryview):
+        self.contents = str(binary_contents, "utf-8")
 
     def __repr__(self):
         return self.contents
@@ -55,9 +117,9 @@ class FotaFormatMetadata(object):
     # The size of the compressed firmware segment.
     payload_size: int = 0
 
-    def __init__(self, contents: io.BytesIO):
-        (self.payload_offset, self.payload_length, self.unknown) = struct.unpack(
-            "<HII", contents.read(10)
+    def __init__(self, contents: memoryview):
+        (self.payload_offset, self.payload_length, self.unknown) = struct.unpack_from(
+            "<HII", contents
         )
 
 
@@ -75,9 +137,9 @@ class FotaSegment(object):
     # Unknown.
     unknown: int = 0
 
-    def __init__(self, contents: io.BytesIO):
-        (self.payload_offset, self.payload_length, self.unknown) = struct.unpack(
-            "<III", contents.read(12)
+    def __init__(self, contents: memoryview, offset: int = 0):
+        (self.payload_offset, self.payload_length, self.unknown) = struct.unpack_from(
+            "<III", contents, offset
         )
 
 
@@ -87,12 +149,16 @@ class FotaSegmentArray(object):
 
     segments: list[FotaSegment] = field(repr=False)
 
-    def __init__(self, contents: io.BytesIO):
+    def __init__(self, contents: memoryview):
         self.segments = []
 
-        segment_count = struct.unpack("<I", contents.read(4))[0]
-        for _ in range(segment_count):
-            current_segment = FotaSegment(contents)
+        segment_count = None
+        if len(contents) >= 4:
+            segment_count = struct.unpack_from("<I", contents)[0]
+        if segment_count is None or 4 + segment_count * 12 > len(contents):
+            raise AssertionError("Segment array extends past its TLV!")
+        for index in range(segment_count):
+            current_segment = FotaSegment(contents, 4 + index * 12)
             self.segments.append(current_segment)
 
 
@@ -102,12 +168,13 @@ class FotaHashes(object):
 
     hashes: list[bytes] = field(repr=False)
 
-    def __init__(self, contents: io.BytesIO):
+    def __init__(self, contents: memoryview):
         self.hashes = []
 
-        hash_count = struct.unpack("<I", contents.read(4))[0]
-        for _ in range(hash_count):
-            current_hash = contents.read(32)
+        hash_count = struct.unpack_from("<I", contents)[0]
+        for index in range(hash_count):
+            hash_offset = 4 + index * 32
+            current_hash = bytes(contents[hash_offset : hash_offset + 32])
             self.hashes.append(current_hash)
 
 
@@ -131,72 +198,67 @@ class FotaMetadata(object):
         self.segments = []
         self.all_metadata = {}
 
-        # We begin with a 256-byte signature.
-        data = io.BytesIO(binary_contents)
-        self.signature = data.read(256)
-
-        while True:
-            # Following our signature, we have an array of TLV entries.
-            # Directly proceeding them is padding filled with 0xFF.
-            #
-            # There appears to be no count of the TLV fields, so we simply
-            # cease reading once we encounter a type of 0xFFFF.
-            # (At worst, we'll fail with an exception.)
-            (data_type, data_length) = struct.unpack_from("<HH", data.read(4))
-            if data_type == 0xFFFF:
-                # We've reached the end of possible TLV types.
-                break
-            data_contents = data.read(data_length)
-            data_stream = io.BytesIO(data_contents)
+        # Our TLVs follow a 256-byte signature.
+        # They are parsed in place, without copying their contents.
+        self.signature = bytes(memoryview(binary_contents)[0:256])
 
+        for data_type, _, data_contents in walk_fota_tlvs(binary_contents):
             # We only handle a subset of known metadata types.
             current_object: object
 
             if data_type == FotaMetadataType.FORMAT_METADATA:
-                current_object = FotaFormatMetadata(data_stream)
+                current_object = FotaFormatMetadata(data_contents)
                 self.format_metadata.append(current_object)
             elif data_type == FotaMetadataType.SEGMENT_METADATA:
-                current_object = FotaSegmentArray(data_stream)
+                current_object = FotaSegmentArray(data_contents)
                 self.segments = current_object.segments
             elif data_type == FotaMetadataType.FIRMWARE_VERSION:
                 # This is a null-terminated string.
                 # Some firmware versions pad this with 0xFF to be 64 bytes.
                 # As such, we'll strip beyond the first null byte.
-                null_pos = data_contents.index(b"\x00")
+                null_pos = data_contents.tobytes().index(b"\x00")
                 current_object = FotaString(data_contents[0:null_pos])
             elif data_type == FotaMetadataType.PARTITION_HASHES:
-                current_object = FotaHashes(data_stream)
+                current_object = FotaHashes(data_contents)
             elif data_type == FotaMetadataType.CHIPSET_NAME:
                 current_object = FotaString(data_contents)
             elif data_type == FotaMetadataType.DESIGN_NAME:
                 current_object = FotaString(data_contents)
             else:
                 # We'll use this as a placeholder object.
-                current_object = FotaUnknown(data_contents)
+                current_object = FotaUnknown(data_contents.tobytes())
 
             self.all_metadata[data_type] = current_object
 
 
 @dataclass
 class FotaPayload(object):
-    """Simple wrapper to assist in decompressing/parsing a FOTA payload."""
+    """Simple wrapper to assist in decompressing/parsing a FOTA payload.
+
+    Decompression is deferred until `decompressed` or `segments` is first accessed,
+    so obtaining metadata alone is inexpensive."""
 
     # The raw bytes for the metadata component of this payload.
-    raw_metadata: bytes
+    raw_metadata: memoryview = field(repr=False)
 
     # Metadata for this FOTA payload.
     metadata: FotaMetadata
 
     # LZMA compressed payload.
-    compressed: bytes = field(repr=False)
+    compressed: memoryview = field(repr=False)
 
-    # Decompressed LZMA payload.
-    decompressed: bytes = field(repr=False)
+    def __init__(
+        self,
+        data: bytes,
+        budget: Optional[MemoryBudget] = None,
+        events: Optional[EventEmitter] = None,
+    ):
+        self.budget = budget
+        self.events = events
 
-    # Segments within.
-    segments: list[bytes] = field(repr=False)
+        # Slices of our data are views, not copies.
+        data = memoryview(data)
 
-    def __init__(self, data: bytes):
         # Our metadata is 4096 bytes in length.
         # This may not be guaranteed, but appears to be consistent
         # across released firmware versions.
@@ -209,18 +271,53 @@ class FotaPayload(object):
         # Our compressed payload starts at 0x1000 and goes to the end.
         self.compressed = data[0x1000:]
 
-        # Decompress our LZMA payload.
-        self.decompressed = lzma.decompress(self.compressed)
+    @cached_property
+    def decompressed(self) -> bytes:
+        """Decompressed LZMA payload."""
+        if self.budget is None and self.events is None:
+            return lzma.decompress(self.compressed)
+
+        # Stream our decompressed output, spilling to disk if we exceed our budget.
+        budget = self.budget or MemoryBudget()
+        declared_size = get_lzma_declared_size(self.compressed)
+        output = budget.buffer(declared_size)
+
+        decompressor = lzma.LZMADecompressor()
+        position = 0
+        while not decompressor.eof:
+            if decompressor.needs_input:
+                current_input = self.compressed[
+                    position : position + DECOMPRESS_READ_SIZE
+                ]
+                position += len(current_input)
+                if not current_input:
+                    raise lzma.LZMAError("Compressed data ended unexpectedly")
+            else:
+                current_input = b""
+            output.write(decompressor.decompress(current_input, DECOMPRESS_READ_SIZE))
+
+            if self.events is not None:
+                self.events.progress(
+                    DecodeProgress("FOTA", output.size, declared_size),
+                    f"fota:{id(self)}",
+                    final=decompressor.eof,
+                )
 
-        # Separate segments within.
-        self.segments = []
+        budget.record(output)
+        return output.getbuffer()
+
+    @cached_property
+    def segments(self) -> list[memoryview]:
+        """Segments within our decompressed payload."""
+        decompressed = memoryview(self.decompressed)
+
+        segments = []
         for segment in self.metadata.segments:
             # Each segment offset is 0x1000 ahead,
             # as the decompressed portions likely
             # overwrites the compressed portion in memory.
             segment_offset_start = segment.payload_offset - 0x1000
             segment_offset_end = segment_offset_start + segment.payload_length
-            segment_contents = self.decompressed[
-                segment_offset_start:segment_offset_end
-            ]
-            self.segments.append(segment_contents)
+            segment_contents = decompressed[segment_offset_start:segment_offset_end]
+            segments.append(segment_contents)
+        return segments
@@ -1,12 +1,27 @@
 import argparse
-import os
+import fnmatch
+import time
+from contextlib import nullcontext
 import pathlib
 import sys
 
 from compressed_payload import decompress_payload_chunks
+from events import EventEmitter, FileWritten, jsonl_writer
 from fota_payload import FotaPayload
+from memory import MemoryBudget, parse_size
+from output import (
+    ArchiveFormat,
+    ArchiveOutput,
+    DeduplicatingOutput,
+    DirectoryOutput,
+    LinkMode,
+    is_zstd_available,
+)
+from pipeline import WritePipeline
+from recursive import RecursiveExtractor
 from rofs import find_rofs
-from super_binary import SuperBinary
+from source import open_source
+from super_binary import SuperBinary, number_repeated
 from uarp_payload import UarpPayload
 
 parser = argparse.ArgumentParser(
@@ -14,14 +29,17 @@ parser = argparse.ArgumentParser(
 )
 parser.add_argument(
     "source",
-    help='Path to the SuperBinary. Typically called "FirmwareUpdate.uarp".',
-    type=argparse.FileType("rb"),
+    help='Path to the SuperBinary, typically called "FirmwareUpdate.uarp", or "-" for standard input.',
 )
 parser.add_argument(
     "output_dir",
-    help="The directory to save payloads to.",
+    help='The directory to save payloads to, or with --archive, the archive to write ("-" for standard output).',
     type=pathlib.Path,
 )
+parser.add_argument(
+    "--member",
+    help="If the source is a zip or tar archive, the name of the SuperBinary within it.",
+)
 parser.add_argument(
     "--extract-payloads",
     help="Whether to extract all payloads of this SuperBinary.",
@@ -44,42 +62,183 @@ parser.add_argument(
     help="Whether to extract the ROFS partition to the output directory.",
     action=argparse.BooleanOptionalAction,
 )
+parser.add_argument(
+    "--extract-fota-intermediates",
+    help="Whether to extract the compressed FOTA, the decompressed FOTA and its segments. By default, these are skipped when --rofs-file is given.",
+    action=argparse.BooleanOptionalAction,
+)
 parser.add_argument(
     "--decompress-payload-contents",
     help="Whether to decompress payload contents in particular types of SuperBinaries.",
     action=argparse.BooleanOptionalAction,
     default=True,
 )
+parser.add_argument(
+    "--dedup-store",
+    help="A directory to store unique outputs within, linking them into the output directory.",
+    type=pathlib.Path,
+)
+parser.add_argument(
+    "--link-mode",
+    help="How outputs within the deduplication store are linked into the output directory.",
+    type=LinkMode,
+    choices=list(LinkMode),
+    default=LinkMode.HARDLINK,
+)
+parser.add_argument(
+    "--archive",
+    help="Stream all outputs into a single archive of this format, rather than a directory.",
+    type=ArchiveFormat,
+    choices=list(ArchiveFormat),
+)
+parser.add_argument(
+    "--max-memory",
+    help="A memory budget (i.e. 512M) shared by all buffers and queued outputs. Buffers exceeding it are spilled to temporary files.",
+    type=parse_size,
+)
+parser.add_argument(
+    "--only-tag",
+    help="Only extract and decompress payloads with this tag. May be repeated.",
+    action="append",
+    default=[],
+)
+parser.add_argument(
+    "--only-path",
+    help="Only extract and decompress payloads whose filepath matches this glob. May be repeated.",
+    action="append",
+    default=[],
+)
+parser.add_argument(
+    "--rofs-file",
+    help="Only extract ROFS files whose name matches this glob. May be repeated.",
+    action="append",
+    default=[],
+)
+parser.add_argument(
+    "--events",
+    help="Emit structured progress events to standard output in the given format. Other output moves to standard error.",
+    choices=["jsonl"],
+)
+parser.add_argument(
+    "--recursive-depth",
+    help="How many levels of nested SuperBinaries, FOTAs, ROFS or compressed data to extract.",
+    type=int,
+    default=0,
+)
+parser.add_argument(
+    "--jobs",
+    help="How many payloads may be decoded and written concurrently.",
+    type=int,
+    default=4,
+)
 args = parser.parse_args()
 if args.extract_rofs and not args.decompress_fota:
     print("Please ensure that --decompress-fota is specified.")
     exit(1)
+if args.extract_fota_intermediates is None:
+    args.extract_fota_intermediates = not args.rofs_file
+if args.jobs < 1:
+    print("Please specify at least one job.")
+    exit(1)
+if args.archive and args.dedup_store:
+    print("Deduplication is not supported when writing an archive.")
+    exit(1)
+if args.archive == ArchiveFormat.TAR_ZST and not is_zstd_available():
+    print("zstd compression requires Python 3.14, or the zstandard package.")
+    exit(1)
+
+# When our archive is written to standard output, nothing else may be.
+archive_to_stdout = args.archive is not None and str(args.output_dir) == "-"
+if archive_to_stdout and args.events:
+    print("Events cannot be emitted while writing an archive to standard output.")
+    exit(1)
+
+
+def is_selected(payload: UarpPayload) -> bool:
+    """Determines whether this payload was selected via --only-tag or --only-path."""
+    if not args.only_tag and not args.only_path:
+        return True
+    if payload.get_tag() in args.only_tag:
+        return True
+
+    filepath = payload.plist_metadata.filepath
+    return filepath is not None and any(
+        fnmatch.fnmatchcase(filepath, pattern) for pattern in args.only_path
+    )
+
+
+def should_read(payload: UarpPayload) -> bool:
+    """Determines whether this payload's contents are needed at all."""
+    if args.decompress_fota and payload.tag == b"FOTA":
+        return True
+    return is_selected(payload)
+
+
+def should_read_tag(tag: bytes) -> bool:
+    """Determines from a payload row's tag alone whether its contents may be needed.
+    Forward-only sources discard payloads for which this is False.
 
+    Selection by filepath requires the plist, which comes last;
+    with --only-path, no payloads can be excluded ahead of time."""
+    if args.only_path or not args.only_tag:
+        return True
+    if args.decompress_fota and tag == b"FOTA":
+        return True
+    return tag.decode("utf-8", errors="replace") in args.only_tag
 
-super_binary = SuperBinary(args.source)
+
+events = None
+if args.events == "jsonl":
+    events = EventEmitter(jsonl_writer(sys.stdout))
+
+
+def log(message: str):
+    """Prints a human-readable message, keeping standard output clear for events or archives."""
+    print(message, file=sys.stderr if events or archive_to_stdout else sys.stdout)
+
+
+def stage(name: str, item: str = None):
+    """Reports the start and end of a stage if events are enabled."""
+    if events is None:
+        return nullcontext()
+    return events.stage(name, item)
+
+
+budget = MemoryBudget(args.max_memory)
+with stage("parse"):
+    super_binary = SuperBinary(
+        open_source(args.source, args.member, budget),
+        budget,
+        select=should_read,
+        events=events,
+        select_tag=should_read_tag,
+    )
 
 # Ensure our payload directory can be written to.
 payload_dir = args.output_dir
-payload_dir.mkdir(parents=True, exist_ok=True)
+if args.archive:
+    output = ArchiveOutput(str(payload_dir), args.archive)
+elif args.dedup_store:
+    output = DeduplicatingOutput(payload_dir, args.dedup_store, args.link_mode)
+else:
+    output = DirectoryOutput(payload_dir)
 
 
 def write_payload(file_name: str, file_contents: bytes):
     """Writes the given payload to the specified path, creating parent directories as necessary."""
+    start = time.monotonic()
+    output.write(file_name, file_contents)
 
-    file_path: pathlib.Path = payload_dir / file_name
-
-    # In the case of fullpaths, we may need to make a parent directory first.
-    file_path.parent.mkdir(parents=True, exist_ok=True)
-
-    with open(file_path, "wb") as f:
-        f.write(file_contents)
+    if events is not None:
+        duration = time.monotonic() - start
+        events.emit(FileWritten(file_name, len(file_contents), duration))
 
 
 def get_payload_filename(payload: UarpPayload) -> str:
     """Determines the name to save this UarpPayload with."""
 
     if args.use_tag_name:
-        payload_filename = f"{tag_name}.bin"
+        payload_filename = f"{payload.get_tag()}.bin"
     else:
         # We want to leverage the payload's given filepath.
         # Ensure its parent directories exist.
@@ -88,86 +247,126 @@ def get_payload_filename(payload: UarpPayload) -> str:
     return payload_filename
 
 
-# Write out payloads if desired.
-if args.extract_payloads:
-    # Used to avoid conflicts in both tag names and fullpaths.
-    seen_filenames: dict[str, int] = {}
-
-    for payload in super_binary.payloads:
-        tag_name = payload.get_tag()
-        payload_name = payload.plist_metadata.long_name or "no payload description"
-        payload_filename = get_payload_filename(payload)
-
-        # Sometimes, tags have multiple payloads, and filepaths conflict.
-        # Let's append a number for every occurrence.
-        seen_count = seen_filenames.get(payload_filename)
-        if seen_count is not None:
-            # We have a tag! Increment its seen count.
-            seen_filenames[payload_filename] += 1
-
-            # Append the count at the end of the file.
-            payload_filename = f"{payload_filename}.{seen_count}"
-        else:
-            seen_filenames[payload_filename] = 1
-
-        print(f"Found {tag_name} ({payload_name})")
-        print(f"Saving to {payload_filename}...")
-
-        # Sometimes, this may be an absolute path.
-        # For example, some filepaths start with `/Library` or `/tmp`.
-        # Tags should (hopefully) never run in to this.
-        #
-        # Let's append `./` to the start to ensure relative resolution.
-        payload_filename = f"./{payload_filename}"
-        write_payload(payload_filename, payload.contents)
-
-    # Lastly, write the SuperBinary plist.
-    write_payload("SuperBinary.plist", super_binary.raw_plist_data)
-
-if args.decompress_fota:
-    # Ensure we have a payload of this type.
-    fota_payload = super_binary.get_tag(b"FOTA")
-    if not fota_payload:
-        print("Missing FOTA payload!")
-        exit(1)
-
-    fota = FotaPayload(fota_payload.contents)
-    write_payload("FOTA.bin.lzma", fota.compressed)
+def decode_fota(fota_payload: UarpPayload):
+    """Decompresses the FOTA, emitting it and its segments (and possibly ROFS)."""
+    fota = FotaPayload(fota_payload.contents, budget, events)
+    if args.extract_fota_intermediates:
+        extractor.submit("FOTA.bin.lzma", fota.compressed, descend=False)
 
     # Decompress payload.
-    write_payload("FOTA", fota.decompressed)
-
-    # Separate segments within.
-    os.makedirs(payload_dir / "segments", exist_ok=True)
-    for i, segment_contents in enumerate(fota.segments):
-        # Each segment offset is 0x1000 ahead
-        # as the decompressed portions likely
-        # overwrites the compressed portion in memory.
-        write_payload(f"segments/{i}.bin", segment_contents)
-
-    print("Extracted FOTA payload!")
+    with stage("decompress_fota"):
+        decompressed = fota.decompressed
+    if args.extract_fota_intermediates:
+        extractor.submit("FOTA", decompressed, descend=False)
+
+        # Separate segments within.
+        for i, segment_contents in enumerate(fota.segments):
+            # Each segment offset is 0x1000 ahead
+            # as the decompressed portions likely
+            # overwrites the compressed portion in memory.
+            # If we're extracting ROFS ourselves, there's no need to descend.
+            extractor.submit(
+                f"segments/{i}.bin", segment_contents, descend=not args.extract_rofs
+            )
+
+    log("Extracted FOTA payload!")
 
     if args.extract_rofs:
-        rofs_partition = find_rofs(fota.segments)
-        os.makedirs(payload_dir / "files", exist_ok=True)
+        with stage("extract_rofs"):
+            rofs_partition = find_rofs(fota.segments)
         for file in rofs_partition.files:
-            write_payload(f"files/{file.file_name}", file.contents)
-
-
-if args.decompress_payload_contents:
-    for payload in super_binary.payloads:
-        # The metadata plist present at the end of the SuperBinary
-        # defines what segments are compressed.
-        # For our purpose, any compressed segment has a `compressed_chunk_size` that is not None.
-        chunk_size = payload.plist_metadata.compressed_chunk_size
-        if not chunk_size:
-            continue
-
-        # TODO(spotlightishere): This should function on platforms beyond macOS.
-        assert (
-            sys.platform == "darwin"
-        ), "Decompression is not yet supported on this platform."
-
-        print(f"Decompressing {payload.get_tag()}...")
-        contents = decompress_payload_chunks(payload)
-        write_payload(f"{payload.get_tag()}.decompressed.bin", contents)
+            if args.rofs_file and not any(
+                fnmatch.fnmatchcase(file.file_name, pattern)
+                for pattern in args.rofs_file
+            ):
+                continue
+            extractor.submit(f"files/{file.file_name}", file.contents)
+
+
+def decode_payload(payload: UarpPayload):
+    """Decompresses the chunks of the given payload."""
+    log(f"Decompressing {payload.get_tag()}...")
+    with stage("decompress_payload", payload.get_tag()):
+        contents = decompress_payload_chunks(payload, budget, events)
+    extractor.submit(f"{payload.get_tag()}.decompressed.bin", contents)
+
+
+# Decoders emit their outputs to writers, allowing us to write
+# while independent payloads are still being decompressed.
+pipeline = WritePipeline(write_payload, workers=args.jobs, budget=budget)
+# Outputs may themselves be containers, which we can descend into.
+extractor = RecursiveExtractor(
+    pipeline,
+    args.recursive_depth,
+    budget,
+    events,
+    args.decompress_fota,
+    args.decompress_payload_contents,
+    log,
+)
+
+try:
+    # Decoding is the most expensive, so we begin it first.
+    if args.decompress_fota:
+        # Ensure we have a payload of this type.
+        fota_payload = super_binary.get_tag(b"FOTA")
+        if not fota_payload:
+            log("Missing FOTA payload!")
+            exit(1)
+
+        pipeline.decode(lambda: decode_fota(fota_payload))
+
+    if args.decompress_payload_contents:
+        for payload in super_binary.payloads:
+            # The metadata plist present at the end of the SuperBinary
+            # defines what segments are compressed.
+            # For our purpose, any compressed segment has a `compressed_chunk_size` that is not None.
+            chunk_size = payload.plist_metadata.compressed_chunk_size
+            if not chunk_size or not is_selected(payload):
+                continue
+
+            pipeline.decode(lambda payload=payload: decode_payload(payload))
+
+    # Write out payloads if desired.
+    if args.extract_payloads:
+        # Names are allocated for all payloads, so that
+        # selected payloads are named consistently.
+        payload_filenames = number_repeated(
+            get_payload_filename(payload) for payload in super_binary.payloads
+        )
+
+        for payload, payload_filename in zip(super_binary.payloads, payload_filenames):
+            if not is_selected(payload):
+                continue
+
+            tag_name = payload.get_tag()
+            payload_name = payload.plist_metadata.long_name or "no payload description"
+            log(f"Found {tag_name} ({payload_name})")
+            log(f"Saving to {payload_filename}...")
+
+            # Sometimes, this may be an absolute path.
+            # For example, some filepaths start with `/Library` or `/tmp`.
+            # Tags should (hopefully) never run in to this.
+            #
+            # Let's append `./` to the start to ensure relative resolution.
+            payload_filename = f"./{payload_filename}"
+
+            # Payloads we decode ourselves need not be descended into.
+            decoded = (args.decompress_fota and payload.tag == b"FOTA") or (
+                args.decompress_payload_contents
+                and payload.plist_metadata.compressed_chunk_size
+            )
+            extractor.submit(payload_filename, payload.contents, descend=not decoded)
+
+        # Lastly, write the SuperBinary plist.
+        extractor.submit(
+            "SuperBinary.plist", super_binary.raw_plist_data, descend=False
+        )
+finally:
+    # Wait for all outstanding decoding and writes.
+    with stage("write"):
+        pipeline.close()
+output.close()
+
+if args.max_memory is not None:
+    log(budget.report())
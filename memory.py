@@ -0,0 +1,258 @@
+import io
+import mmap
+import os
+import resource
+import sys
+import tempfile
+import threading
+import weakref
+from typing import BinaryIO, Optional
+
+# Size suffixes accepted by `parse_size`.
+SIZE_SUFFIXES = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_size(value: str) -> int:
+    """Parses a size such as "512M" or "2G" into bytes."""
+    value = value.strip().upper().removesuffix("B")
+    multiplier = SIZE_SUFFIXES.get(value[-1:], 1)
+    if value[-1:] in SIZE_SUFFIXES:
+        value = value[:-1]
+    return int(float(value) * multiplier)
+
+
+def map_file(file: BinaryIO) -> memoryview:
+    """Maps the given file read-only, returning a view over its contents."""
+    file.flush()
+    if os.fstat(file.fileno()).st_size == 0:
+        # Empty files cannot be mapped.
+        return memoryview(b"")
+    return memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+class ReservedBuffer(bytearray):
+    """An in-memory buffer whose size has been reserved against a MemoryBudget.
+    Its reservation is released once it (and every view of it) is freed."""
+
+    def __init__(self, budget: "MemoryBudget", size: int = 0):
+        super().__init__(size)
+        self.reservation = Reservation(budget, size)
+        weakref.finalize(self, self.reservation.release)
+
+
+class Reservation(object):
+    """Bytes reserved against a MemoryBudget by a single buffer."""
+
+    def __init__(self, budget: "MemoryBudget", size: int = 0):
+        self.budget = budget
+        self.size = size
+
+    def grow(self, size: int) -> bool:
+        """Attempts to reserve the given additional size."""
+        if not self.budget.try_reserve(size):
+            return False
+        self.size += size
+        return True
+
+    def release(self):
+        self.budget.release(self.size)
+        self.size = 0
+
+
+class SpillBuffer(object):
+    """A write-once buffer held in memory until our budget cannot reserve
+    its size, at which point it moves to a temporary file.
+
+    Its contents are obtained via `getbuffer()`, which returns a view of
+    either the in-memory buffer or a read-only mapping of the file,
+    without copying."""
+
+    def __init__(self, budget: "MemoryBudget", projected_size: Optional[int] = None):
+        self.size = 0
+        self.memory: Optional[ReservedBuffer] = None
+        self.file: Optional[BinaryIO] = None
+
+        # If we already know we won't fit, begin on disk.
+        memory = ReservedBuffer(budget)
+        if projected_size is not None and not memory.reservation.grow(projected_size):
+            self.file = tempfile.TemporaryFile()
+        else:
+            self.memory = memory
+
+    @property
+    def spilled(self) -> bool:
+        return self.file is not None
+
+    def write(self, contents: bytes):
+        if not self.spilled:
+            reservation = self.memory.reservation
+            growth = self.size + len(contents) - reservation.size
+            if growth <= 0 or reservation.grow(growth):
+                self.memory += contents
+                self.size += len(contents)
+                return
+
+            # Move what we have so far to disk, releasing its reservation.
+            self.file = tempfile.TemporaryFile()
+            self.file.write(self.memory)
+            self.memory = None
+
+        self.file.write(contents)
+        self.size += len(contents)
+
+    def getbuffer(self) -> memoryview:
+        if self.spilled:
+            return map_file(self.file)
+        return memoryview(self.memory)
+
+
+class BufferReader(io.RawIOBase):
+    """A read-only file over an in-memory or memory-mapped buffer.
+
+    Reads return memoryview slices of the buffer rather than copies.
+    For mapped files, this allows the operating system to page contents
+    in and out as needed."""
+
+    def __init__(self, buffer: bytes, position: int = 0):
+        super().__init__()
+        self.view = memoryview(buffer)
+        self.position = position
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        self.position = offset
+        return self.position
+
+    def read(self, size: Optional[int] = -1) -> memoryview:
+        if size is None or size < 0:
+            end = len(self.view)
+        else:
+            end = min(self.position + size, len(self.view))
+        contents = self.view[self.position : end]
+        self.position = max(self.position, end)
+        return contents
+
+
+class MemoryBudget(object):
+    """A memory budget shared by every stage of an extraction.
+
+    Buffers held in memory reserve their size against a running total,
+    which is released once they are freed. Should a reservation exceed our
+    maximum, that buffer is instead backed by a temporary file or a memory
+    mapping. Outputs queued for writing reserve their size too (see
+    `WritePipeline`), blocking rather than spilling.
+    Without a maximum, everything is held in memory as usual."""
+
+    max_memory: Optional[int]
+    # Bytes currently reserved.
+    reserved: int
+    # The most bytes reserved at once.
+    peak_reserved: int
+    # How many buffers were moved to disk.
+    spilled_count: int
+
+    def __init__(self, max_memory: Optional[int] = None):
+        self.max_memory = max_memory
+        self.reserved = 0
+        self.peak_reserved = 0
+        self.spilled_count = 0
+        self.lock = threading.Lock()
+
+    def try_reserve(self, size: int) -> bool:
+        """Reserves the given size if it fits within our budget."""
+        with self.lock:
+            if self.max_memory is not None and self.reserved + size > self.max_memory:
+                return False
+            self.reserved += size
+            self.peak_reserved = max(self.peak_reserved, self.reserved)
+            return True
+
+    def force_reserve(self, size: int):
+        """Reserves the given size, even if it exceeds our maximum."""
+        with self.lock:
+            self.reserved += size
+            self.peak_reserved = max(self.peak_reserved, self.reserved)
+
+    def release(self, size: int):
+        with self.lock:
+            self.reserved -= size
+
+    @staticmethod
+    def is_accounted(contents: bytes) -> bool:
+        """Returns whether the given contents are a view of a reserved or
+        memory-mapped buffer, and so hold no memory beyond it."""
+        return isinstance(contents, memoryview) and isinstance(
+            contents.obj, (ReservedBuffer, mmap.mmap)
+        )
+
+    def buffer(self, projected_size: Optional[int] = None) -> SpillBuffer:
+        """Returns a buffer which spills to disk should it exceed our budget."""
+        return SpillBuffer(self, projected_size)
+
+    def arena(self, size: int) -> memoryview:
+        """Returns a writable, zero-filled buffer of exactly the given size.
+
+        If it would not fit within our budget, it is a shared mapping of a
+        temporary file, allowing the operating system to page it out."""
+        if size == 0 or self.try_reserve(size):
+            return memoryview(ReservedBuffer(self, size))
+
+        self.record_spill()
+        with tempfile.TemporaryFile() as arena_file:
+            arena_file.truncate(size)
+            # Our mapping remains valid once its file is closed.
+            return memoryview(mmap.mmap(arena_file.fileno(), size))
+
+    def map_source(self, data: BinaryIO) -> BinaryIO:
+        """Returns a mapping of the given file if we have a maximum, so that
+        payloads are paged in from it rather than read into memory.
+        Sources which are not regular files are returned as-is."""
+        if self.max_memory is None:
+            return data
+        try:
+            os.fstat(data.fileno())
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            return data
+        if not data.seekable():
+            return data
+
+        return BufferReader(map_file(data), data.tell())
+
+    def record(self, buffer: SpillBuffer):
+        """Records the outcome of a completed buffer."""
+        if buffer.spilled:
+            self.record_spill()
+
+    def record_spill(self):
+        with self.lock:
+            self.spilled_count += 1
+
+    @staticmethod
+    def get_peak_usage() -> int:
+        """Returns the peak resident set size of this process, in bytes."""
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS reports bytes, while Linux reports kilobytes.
+        if sys.platform == "darwin":
+            return peak
+        return peak * 1024
+
+    def report(self) -> str:
+        """Returns a human-readable summary of memory usage."""
+        budget = "unlimited" if self.max_memory is None else f"{self.max_memory} bytes"
+        return (
+            f"Peak memory usage: {self.get_peak_usage()} bytes (budget {budget}); "
+            f"at most {self.peak_reserved} bytes reserved at once, "
+            f"{self.spilled_count} buffers spilled to disk."
+        )
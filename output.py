@@ -0,0 +1,261 @@
+import errno
+import hashlib
+import importlib.util
+import os
+import pathlib
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from enum import Enum
+from typing import BinaryIO
+
+from memory import BufferReader
+
+# ioctl used to clone (reflink) a file on Linux, i.e. with Btrfs or XFS.
+FICLONE = 0x40049409
+
+
+class LinkMode(Enum):
+    """How deduplicated objects are placed within an output directory."""
+
+    HARDLINK = "hardlink"
+    REFLINK = "reflink"
+
+
+class ArchiveFormat(Enum):
+    """Formats which outputs can be streamed into as a single archive."""
+
+    TAR = "tar"
+    TAR_GZ = "tar.gz"
+    TAR_ZST = "tar.zst"
+    ZIP = "zip"
+
+
+class DirectoryOutput(object):
+    """Writes extracted contents as files beneath an output directory."""
+
+    output_dir: pathlib.Path
+
+    def __init__(self, output_dir: pathlib.Path):
+        self.output_dir = output_dir
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+
+    def get_path(self, file_name: str) -> pathlib.Path:
+        """Returns the path for the given file, creating parent directories as necessary."""
+        file_path = self.output_dir / file_name
+
+        # In the case of fullpaths, we may need to make a parent directory first.
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        return file_path
+
+    def write(self, file_name: str, file_contents: bytes):
+        """Writes the given contents to the specified path."""
+        with open(self.get_path(file_name), "wb") as f:
+            f.write(file_contents)
+
+    def close(self):
+        """Finalizes all output. Nothing is required for plain directories."""
+        pass
+
+
+class DeduplicatingOutput(DirectoryOutput):
+    """Writes each unique content once into a hash-addressed object store,
+    and links it into the output directory.
+
+    Objects are named by their SHA-256 digest, i.e. `objects/ab/cdef...`.
+    As they may be shared across many extractions, they are made read-only."""
+
+    store_dir: pathlib.Path
+    link_mode: LinkMode
+
+    def __init__(
+        self,
+        output_dir: pathlib.Path,
+        store_dir: pathlib.Path,
+        link_mode: LinkMode = LinkMode.HARDLINK,
+    ):
+        super().__init__(output_dir)
+        self.store_dir = store_dir
+        self.link_mode = link_mode
+
+        (self.store_dir / "objects").mkdir(parents=True, exist_ok=True)
+        (self.store_dir / "tmp").mkdir(parents=True, exist_ok=True)
+
+    def get_object_path(self, digest: str) -> pathlib.Path:
+        return self.store_dir / "objects" / digest[0:2] / digest[2:]
+
+    def store(self, file_contents: bytes) -> pathlib.Path:
+        """Stores the given contents if not already present, returning its object path."""
+        # Our contents are already in memory, so we can hash before writing.
+        # Duplicates then never touch the disk at all.
+        digest = hashlib.sha256(file_contents).hexdigest()
+        object_path = self.get_object_path(digest)
+        if object_path.exists():
+            return object_path
+
+        # Write to a temporary file and then rename it into place.
+        # This ensures concurrent extractions never observe partial objects.
+        object_path.parent.mkdir(exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.store_dir / "tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(file_contents)
+            os.chmod(temp_path, 0o444)
+            os.replace(temp_path, object_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+        return object_path
+
+    def write(self, file_name: str, file_contents: bytes):
+        object_path = self.store(file_contents)
+        file_path = self.get_path(file_name)
+
+        # Re-extracting over a previous output replaces its links.
+        if file_path.exists() or file_path.is_symlink():
+            file_path.unlink()
+
+        if self.link_mode == LinkMode.HARDLINK:
+            try:
+                os.link(object_path, file_path)
+                return
+            except OSError as e:
+                # Our store may be on another device; fall back to a copy.
+                if e.errno not in [errno.EXDEV, errno.EMLINK, errno.EPERM]:
+                    raise
+        else:
+            if reflink(object_path, file_path):
+                return
+
+        shutil.copyfile(object_path, file_path)
+
+
+class ArchiveOutput(object):
+    """Streams all extracted contents into a single tar or zip archive,
+    written sequentially to a file or to standard output ("-").
+
+    Nothing is written to disk besides the archive itself. As archives are
+    written one member at a time, writes from multiple threads are serialized."""
+
+    destination: str
+    archive_format: ArchiveFormat
+
+    def __init__(self, destination: str, archive_format: ArchiveFormat):
+        self.destination = destination
+        self.archive_format = archive_format
+        self.lock = threading.Lock()
+        # All members share the time our archive was created.
+        self.mtime = time.time()
+
+        if destination == "-":
+            self.stream: BinaryIO = sys.stdout.buffer
+        else:
+            self.stream = open(destination, "wb")
+
+        # Layers we create are closed in reverse order.
+        self.compressor = None
+        if archive_format == ArchiveFormat.ZIP:
+            # zipfile writes data descriptors when its stream is not seekable.
+            self.archive = zipfile.ZipFile(
+                self.stream, "w", compression=zipfile.ZIP_DEFLATED
+            )
+        elif archive_format == ArchiveFormat.TAR_ZST:
+            self.compressor = open_zstd_writer(self.stream)
+            self.archive = tarfile.open(fileobj=self.compressor, mode="w|")
+        elif archive_format == ArchiveFormat.TAR_GZ:
+            self.archive = tarfile.open(fileobj=self.stream, mode="w|gz")
+        else:
+            self.archive = tarfile.open(fileobj=self.stream, mode="w|")
+
+    @staticmethod
+    def get_member_name(file_name: str) -> str:
+        """Normalizes names such as "./payload.bin" or ".//Library/file" to be relative."""
+        return pathlib.PurePosixPath(file_name).as_posix().lstrip("/")
+
+    def write(self, file_name: str, file_contents: bytes):
+        member_name = self.get_member_name(file_name)
+        with self.lock:
+            if self.archive_format == ArchiveFormat.ZIP:
+                info = zipfile.ZipInfo(member_name, time.localtime(self.mtime)[0:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.external_attr = 0o644 << 16
+                self.archive.writestr(info, file_contents)
+                return
+
+            info = tarfile.TarInfo(member_name)
+            info.size = len(file_contents)
+            info.mtime = self.mtime
+            info.mode = 0o644
+            # Our contents are read as views, without copying.
+            self.archive.addfile(info, BufferReader(file_contents))
+
+    def close(self):
+        """Writes the archive's trailer and closes it."""
+        with self.lock:
+            self.archive.close()
+            if self.compressor is not None:
+                self.compressor.close()
+            if self.stream is sys.stdout.buffer:
+                self.stream.flush()
+            else:
+                self.stream.close()
+
+
+def is_zstd_available() -> bool:
+    """Returns whether zstd compression is available, via either
+    the standard library (Python 3.14) or the zstandard package.
+    Neither is imported to determine this."""
+    # Finding a submodule imports its parent, so we must first ensure it exists.
+    if importlib.util.find_spec("compression") is not None:
+        if importlib.util.find_spec("compression.zstd") is not None:
+            return True
+    return importlib.util.find_spec("zstandard") is not None
+
+
+def open_zstd_writer(stream: BinaryIO) -> BinaryIO:
+    """Returns a writer compressing to the given stream with zstd.
+    Closing it does not close the underlying stream.
+
+    Callers should check `is_zstd_available` before creating any output."""
+    # Python 3.14 and above include zstd within the standard library.
+    try:
+        from compression import zstd
+
+        return zstd.ZstdFile(stream, "w")
+    except ImportError:
+        pass
+
+    try:
+        import zstandard
+    except ImportError:
+        raise AssertionError(
+            "zstd compression requires Python 3.14, or the zstandard package."
+        )
+    return zstandard.ZstdCompressor().stream_writer(stream, closefd=False)
+
+
+def reflink(source: pathlib.Path, destination: pathlib.Path) -> bool:
+    """Attempts to clone the given file. Returns False if unsupported.
+
+    Cloning is only implemented via the FICLONE ioctl on Linux; on all other
+    platforms, this returns False, and the caller falls back to a copy."""
+    if not sys.platform.startswith("linux"):
+        return False
+    import fcntl
+
+    with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+        try:
+            fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+            return True
+        except OSError as e:
+            if e.errno not in [errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY]:
+                raise
+
+    # Remove our empty destination so that it can be copied normally.
+    destination.unlink()
+    return False
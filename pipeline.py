@@ -0,0 +1,137 @@
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional
+
+from memory import MemoryBudget
+
+# Signals writer threads to exit.
+_STOP = object()
+
+
+class WritePipeline(object):
+    """Decouples decoding from writing.
+
+    Decoders submit outputs into a bounded queue, which a pool of writer threads
+    drains concurrently. If the queue is full, submitters block until space frees.
+    If a memory budget is given, queued outputs also reserve their size against it
+    (unless they are views of buffers that already have), and submitters block
+    while it would be exceeded, bounding how much decoded data is held at once.
+
+    Decoding jobs can be run on `decoders`. Both decompression via lzma and
+    libcompression release the GIL, so decoding overlaps with writing."""
+
+    def __init__(
+        self,
+        write: Callable[[str, bytes], None],
+        workers: int = 4,
+        max_queued: int = 16,
+        budget: Optional[MemoryBudget] = None,
+    ):
+        self.write = write
+        self.budget = budget
+        self.queue: queue.Queue = queue.Queue(maxsize=max_queued)
+        # Signalled whenever a queued output is written, releasing its reservation.
+        self.written = threading.Condition()
+        self.reserved_outputs = 0
+        self.error: Optional[BaseException] = None
+        self.decoders = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="decoder"
+        )
+        self.decode_jobs: list[Future] = []
+        self.decode_lock = threading.Lock()
+
+        self.writers = [
+            threading.Thread(target=self.drain, name=f"writer-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for writer in self.writers:
+            writer.start()
+
+    def drain(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is _STOP:
+                    return
+
+                file_name, file_contents, reserved_size = item
+                # Once an error has occurred, drain without writing.
+                if self.error is None:
+                    try:
+                        self.write(file_name, file_contents)
+                    except BaseException as e:
+                        self.error = e
+                if reserved_size:
+                    self.release(reserved_size)
+            finally:
+                self.queue.task_done()
+
+    def submit(self, file_name: str, file_contents: bytes):
+        """Queues the given contents to be written, blocking if the queue is full."""
+        if self.error is not None:
+            raise self.error
+        reserved_size = self.reserve(file_contents)
+        self.queue.put((file_name, file_contents, reserved_size))
+
+    def reserve(self, file_contents: bytes) -> int:
+        """Reserves the size of the given contents against our budget,
+        waiting for queued outputs to be written while it would be exceeded."""
+        if self.budget is None or self.budget.is_accounted(file_contents):
+            return 0
+
+        size = len(file_contents)
+        with self.written:
+            while not self.budget.try_reserve(size):
+                # If nothing else is queued, waiting cannot free anything.
+                if not self.reserved_outputs:
+                    self.budget.force_reserve(size)
+                    break
+                self.written.wait()
+            self.reserved_outputs += 1
+        return size
+
+    def release(self, size: int):
+        with self.written:
+            self.budget.release(size)
+            self.reserved_outputs -= 1
+            self.written.notify_all()
+
+    def decode(self, job: Callable[[], None]):
+        """Runs the given decoding job in the background.
+        It should submit its outputs to this pipeline.
+
+        Jobs may themselves start further decoding jobs."""
+        with self.decode_lock:
+            self.decode_jobs.append(self.decoders.submit(job))
+
+    def close(self):
+        """Waits for all decoding and writing to complete, raising the first error."""
+        decode_error: Optional[BaseException] = None
+        try:
+            # Jobs start any further jobs before they complete.
+            # Once we've waited on every job, no more can be started.
+            # Even if a job fails, we wait on all others, so that none are
+            # still running (or starting further jobs) once we shut down.
+            index = 0
+            while True:
+                with self.decode_lock:
+                    if index >= len(self.decode_jobs):
+                        break
+                    job = self.decode_jobs[index]
+                index += 1
+
+                error = job.exception()
+                if error is not None and decode_error is None:
+                    decode_error = error
+        finally:
+            self.decoders.shutdown()
+            for _ in self.writers:
+                self.queue.put(_STOP)
+            for writer in self.writers:
+                writer.join()
+
+        if decode_error is not None:
+            raise decode_error
+        if self.error is not None:
+            raise self.error
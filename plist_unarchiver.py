@@ -114,3 +114,72 @@ class SomewhatKeyedUnarchiver(object):
 
         # NSStrings simply contain their string value under "NS.string".
         return array["NS.string"]
+
+
+class SomewhatKeyedArchiver(object):
+    """A similarly loose counterpart to SomewhatKeyedUnarchiver.
+
+    Dictionaries and lists are archived as NSDictionary and NSArray, and
+    all other values (strings, numbers, booleans, data) are stored as-is.
+    It produces only what SomewhatKeyedUnarchiver is able to read."""
+
+    objects: list
+
+    def __init__(self):
+        # "$null" is always our first object.
+        self.objects = ["$null"]
+        self.class_uids = {}
+        # Strings are archived once, and referenced thereafter.
+        self.string_uids = {}
+
+    def add_object(self, current_object: any) -> plistlib.UID:
+        self.objects.append(current_object)
+        return plistlib.UID(len(self.objects) - 1)
+
+    def get_class_uid(self, class_name: str) -> plistlib.UID:
+        """Returns the UID for the given class's info, archiving it if necessary."""
+        if class_name not in self.class_uids:
+            self.class_uids[class_name] = self.add_object(
+                {"$classname": class_name, "$classes": [class_name, "NSObject"]}
+            )
+        return self.class_uids[class_name]
+
+    def archive_object(self, current_object: any) -> plistlib.UID:
+        """Archives an object, returning its UID."""
+        if isinstance(current_object, dict):
+            # Reserve our index, so that we precede our contents.
+            archived = {}
+            uid = self.add_object(archived)
+            archived["NS.keys"] = [self.archive_object(key) for key in current_object]
+            archived["NS.objects"] = [
+                self.archive_object(value) for value in current_object.values()
+            ]
+            archived["$class"] = self.get_class_uid("NSDictionary")
+            return uid
+        elif isinstance(current_object, list):
+            archived = {}
+            uid = self.add_object(archived)
+            archived["NS.objects"] = [
+                self.archive_object(value) for value in current_object
+            ]
+            archived["$class"] = self.get_class_uid("NSArray")
+            return uid
+        elif isinstance(current_object, str):
+            if current_object not in self.string_uids:
+                self.string_uids[current_object] = self.add_object(current_object)
+            return self.string_uids[current_object]
+        else:
+            return self.add_object(current_object)
+
+    def archive_root_object(self, root_object: dict) -> bytes:
+        """Archives the given root object, returning a binary plist."""
+        root_uid = self.archive_object(root_object)
+        return plistlib.dumps(
+            {
+                "$archiver": "NSKeyedArchiver",
+                "$version": 100000,
+                "$top": {"root": root_uid},
+                "$objects": self.objects,
+            },
+            fmt=plistlib.FMT_BINARY,
+        )
@@ -0,0 +1,220 @@
+import struct
+from enum import Enum
+from typing import Callable, Optional
+
+from compressed_payload import (
+    ChunkError,
+    CompressionTypes,
+    decompress_chunks,
+    libcompression,
+    walk_chunks,
+)
+from events import EventEmitter
+from fota_payload import FotaMetadataType, FotaPayload, walk_fota_tlvs
+from memory import BufferReader, MemoryBudget
+from pipeline import WritePipeline
+from rofs import ROFS
+from super_binary import SuperBinary, number_repeated
+
+
+class ContainerType(Enum):
+    """Container formats which can be found nested within outputs."""
+
+    SUPER_BINARY = "SuperBinary"
+    FOTA = "FOTA"
+    ROFS = "ROFS"
+    CHUNKED = "chunked"
+
+
+def is_super_binary(contents: memoryview) -> bool:
+    """Checks for a plausible SuperBinary header and first payload row."""
+    if len(contents) < 0x2C + 4:
+        return False
+    header_version, header_length, binary_size = struct.unpack_from(">III", contents)
+    if header_version not in [2, 3] or header_length != 0x2C:
+        return False
+    if binary_size > len(contents):
+        return False
+
+    # Our row table immediately follows, with each row beginning with its size.
+    (row_length,) = struct.unpack_from(">I", contents, 0x28)
+    if row_length == 0 or row_length % 0x28 != 0:
+        return False
+    (row_size,) = struct.unpack_from(">I", contents, 0x2C)
+    return row_size == 0x28
+
+
+def is_rofs(contents: memoryview) -> bool:
+    """Checks for ROFS magic and a consistent length."""
+    if len(contents) < 16:
+        return False
+    magic, length_one, length_two, file_count = struct.unpack_from("<4sIII", contents)
+    return magic == b"ROFS" and length_one == length_two and file_count != 0
+
+
+def is_fota(contents: memoryview) -> bool:
+    """Checks for FOTA metadata TLVs followed by an LZMA stream."""
+    if len(contents) < 0x1000 + 13:
+        return False
+
+    # We expect to find segment metadata before our 4096 byte metadata ends.
+    try:
+        found_segments = any(
+            data_type == FotaMetadataType.SEGMENT_METADATA
+            for data_type, _, _ in walk_fota_tlvs(contents[0:0x1000])
+        )
+    except AssertionError:
+        return False
+    # LZMA alone properties must be below 225.
+    return found_segments and contents[0x1000] < 225
+
+
+def get_chunk_size(contents: memoryview) -> Optional[int]:
+    """If the given contents are chunk-compressed, and can be decompressed
+    on this platform, returns their chunk size.
+
+    Nested payloads have no plist specifying their chunk size, so we assume
+    the first chunk is full-sized. Our chunks must end exactly at our end."""
+    try:
+        headers = list(walk_chunks(contents, None))
+    except ChunkError:
+        return None
+
+    first_header = headers[0]
+    if first_header.compressed_length == 0 or first_header.decompressed_length == 0:
+        return None
+    if headers[-1].end != len(contents):
+        return None
+    if libcompression is None and any(
+        header.compression_type != CompressionTypes.PASSTHROUGH for header in headers
+    ):
+        # We cannot decompress these chunks on this platform.
+        return None
+    return first_header.decompressed_length
+
+
+def sniff(
+    contents: bytes, decompress_fota: bool = True, decompress_chunked: bool = True
+) -> Optional[ContainerType]:
+    """Determines whether the given contents are a known container format.
+    FOTAs and chunked contents are only considered if they may be decompressed."""
+    contents = memoryview(contents)
+    if is_super_binary(contents):
+        return ContainerType.SUPER_BINARY
+    if is_rofs(contents):
+        return ContainerType.ROFS
+    if decompress_fota and is_fota(contents):
+        return ContainerType.FOTA
+    if decompress_chunked and get_chunk_size(contents) is not None:
+        return ContainerType.CHUNKED
+    return None
+
+
+class RecursiveExtractor(object):
+    """Submits outputs to a pipeline, descending into nested containers.
+
+    Each nested container is extracted beneath `<name>.extracted/` directly from
+    its in-memory buffer, as its own decoding job, so that independent subtrees
+    are processed in parallel.
+
+    As containers are only guessed at, failing to extract one is logged,
+    rather than failing the extraction as a whole. Nested FOTAs and chunked
+    contents are only decompressed if permitted."""
+
+    def __init__(
+        self,
+        pipeline: WritePipeline,
+        max_depth: int,
+        budget: Optional[MemoryBudget] = None,
+        events: Optional[EventEmitter] = None,
+        decompress_fota: bool = True,
+        decompress_payload_contents: bool = True,
+        log: Callable[[str], None] = print,
+    ):
+        self.pipeline = pipeline
+        self.max_depth = max_depth
+        self.budget = budget
+        self.events = events
+        self.decompress_fota = decompress_fota
+        self.decompress_payload_contents = decompress_payload_contents
+        self.log = log
+
+    def submit(self, file_name: str, contents: bytes, depth: int = 0, descend: bool = True):
+        """Writes the given output, and schedules extraction of any nested container."""
+        self.pipeline.submit(file_name, contents)
+        if not descend or depth >= self.max_depth:
+            return
+
+        container = sniff(
+            contents, self.decompress_fota, self.decompress_payload_contents
+        )
+        if container is None:
+            return
+
+        prefix = f"{file_name}.extracted"
+        self.pipeline.decode(
+            lambda: self.descend(prefix, contents, container, depth + 1)
+        )
+
+    def descend(
+        self, prefix: str, contents: bytes, container: ContainerType, depth: int
+    ):
+        """Extracts a nested container. Its outputs are at the given depth."""
+        try:
+            self.extract(prefix, contents, container, depth)
+        except Exception as e:
+            self.log(f"Unable to extract {container.value} within {prefix}: {e!r}")
+
+    def extract(
+        self, prefix: str, contents: bytes, container: ContainerType, depth: int
+    ):
+        if container == ContainerType.SUPER_BINARY:
+            self.extract_super_binary(prefix, contents, depth)
+        elif container == ContainerType.FOTA:
+            self.extract_fota(prefix, contents, depth)
+        elif container == ContainerType.ROFS:
+            self.extract_rofs(prefix, contents, depth)
+        elif container == ContainerType.CHUNKED:
+            chunk_size = get_chunk_size(memoryview(contents))
+            decompressed = decompress_chunks(
+                contents, chunk_size, self.budget, self.events, prefix
+            )
+            self.submit(f"{prefix}/decompressed.bin", decompressed, depth)
+
+    def extract_super_binary(self, prefix: str, contents: bytes, depth: int):
+        super_binary = SuperBinary(BufferReader(contents), self.budget, events=self.events)
+        self.submit(f"{prefix}/SuperBinary.plist", super_binary.raw_plist_data, depth, False)
+
+        tag_names = [payload.get_tag() for payload in super_binary.payloads]
+        payload_filenames = number_repeated(f"{tag_name}.bin" for tag_name in tag_names)
+        for payload, tag_name, payload_filename in zip(
+            super_binary.payloads, tag_names, payload_filenames
+        ):
+            chunk_size = payload.plist_metadata.compressed_chunk_size
+            decompress = chunk_size and self.decompress_payload_contents
+            self.submit(
+                f"{prefix}/{payload_filename}", payload.contents, depth, not decompress
+            )
+            if not decompress:
+                continue
+
+            # A payload we cannot decompress should not prevent the remainder.
+            try:
+                decompressed = decompress_chunks(
+                    payload.contents, chunk_size, self.budget, self.events, tag_name
+                )
+            except Exception as e:
+                self.log(f"Unable to decompress {tag_name} within {prefix}: {e!r}")
+                continue
+            self.submit(f"{prefix}/{tag_name}.decompressed.bin", decompressed, depth)
+
+    def extract_fota(self, prefix: str, contents: bytes, depth: int):
+        fota = FotaPayload(contents, self.budget, self.events)
+        self.submit(f"{prefix}/FOTA", fota.decompressed, depth, False)
+        for i, segment_contents in enumerate(fota.segments):
+            self.submit(f"{prefix}/segments/{i}.bin", segment_contents, depth)
+
+    def extract_rofs(self, prefix: str, contents: bytes, depth: int):
+        rofs_partition = ROFS(contents)
+        for file in rofs_partition.files:
+            self.submit(f"{prefix}/files/{file.file_name}", file.contents, depth)
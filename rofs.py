@@ -1,6 +1,5 @@
 import struct
 from dataclasses import dataclass, field
-from io import BytesIO
 
 
 @dataclass
@@ -14,15 +13,17 @@ class ROFSFile(object):
 class ROFS(object):
     """Simple class to parse contents within a ROFS partition."""
 
-    files: [ROFSFile] = []
+    files: [ROFSFile]
 
     def __init__(self, passed_data: bytes):
-        # Create a buffer we can read against.
-        data = BytesIO(passed_data)
+        self.files = []
+
+        # Parse in place, so that file contents are views rather than copies.
+        data = memoryview(passed_data)
 
         # Ensure the header is correct.
         magic, length_one, length_two, file_count = struct.unpack_from(
-            "<4sIII", data.read(16)
+            "<4sIII", data
         )
         assert magic == b"ROFS", "Invalid ROFS magic!"
         assert length_one == length_two, "Invalid ROFS length!"
@@ -31,13 +32,13 @@ class ROFS(object):
         # Begin parsing.
         for index in range(file_count):
             file_name, file_offset, file_length = struct.unpack_from(
-                "<4x32s4xII24x", data.read(72)
+                "<4x32s4xII24x", data, 16 + index * 72
             )
             # Determine filename based on null terminator.
             file_name = file_name.split(b"\x00")[0]
             file_name = file_name.decode("utf-8")
 
-            contents = passed_data[file_offset : file_offset + file_length]
+            contents = data[file_offset : file_offset + file_length]
             file = ROFSFile(file_name, contents)
             self.files.append(file)
 
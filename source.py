@@ -0,0 +1,327 @@
+import bisect
+import io
+import pathlib
+import sys
+import tarfile
+import tempfile
+import zipfile
+from typing import BinaryIO, Iterable, Optional
+
+from memory import MemoryBudget, SpillBuffer
+
+# Skipped data is kept in memory up to this size before spilling to disk.
+SPILL_MEMORY_LIMIT = 16 * 1024 * 1024
+# The size of each read while skipping forward.
+SKIP_READ_SIZE = 1024 * 1024
+
+
+class ForwardReader(io.BufferedIOBase):
+    """Presents a forward-only stream (i.e. a pipe, or a compressed archive member)
+    as seekable, for the access patterns SuperBinary requires.
+
+    Everything read is retained so that it can be revisited.
+    Data that is skipped over by seeking forward is handled in one of two ways:
+     - If regions have been declared via `declare_regions`, skipped data within
+       those regions is retained and everything else is discarded.
+     - Otherwise, we cannot know what may be needed later, so skipped data
+       is spilled to a temporary file (held in memory while small).
+
+    If a memory budget is given, declared regions are buffered against it.
+    Those which do not fit are retained within temporary files, and are read back
+    as memory-mapped views."""
+
+    def __init__(self, stream: BinaryIO, budget: Optional[MemoryBudget] = None):
+        super().__init__()
+        self.stream = stream
+        self.budget = budget
+        # Our logical position, as seen by callers.
+        self.position = 0
+        # How far we've consumed the underlying stream.
+        self.stream_position = 0
+
+        # Retained pieces, sorted by their start offset.
+        # Each is (start, length, data), where data is either bytes or a spill offset.
+        self.piece_starts: list[int] = []
+        self.pieces: list[tuple[int, int, object]] = []
+
+        # Declared regions, as sorted (start, end) tuples.
+        self.regions: Optional[list[tuple[int, int]]] = None
+        self.spill: Optional[tempfile.SpooledTemporaryFile] = None
+        # Buffers for partially consumed declared regions, by start offset.
+        self.region_buffers: dict[int, SpillBuffer] = {}
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        # While we permit some seeking, callers must not assume arbitrary access.
+        return False
+
+    def tell(self) -> int:
+        return self.position
+
+    def declare_regions(self, regions: list[tuple[int, int]]):
+        """Declares the (offset, length) regions that will be read in the future.
+
+        Skipped data outside of these regions is discarded rather than spilled."""
+        self.regions = sorted(
+            (offset, offset + length) for offset, length in regions if length
+        )
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            self.skip_to(None)
+            offset += self.stream_position
+        elif whence != io.SEEK_SET:
+            raise ValueError(f"Invalid whence {whence}")
+
+        if offset < 0:
+            raise ValueError("Negative seek position")
+        self.position = offset
+        return self.position
+
+    def read(self, size: Optional[int] = -1) -> bytes:
+        if size is None or size < 0:
+            # Read everything remaining.
+            end = None
+        else:
+            end = self.position + size
+
+        # With a budget, declared regions are always consumed via their buffers.
+        region = self.find_region(self.position)
+        if (
+            self.budget is not None
+            and region is not None
+            and region[0] <= self.position
+            and end is not None
+            and end <= region[1]
+        ):
+            self.skip_to(region[1])
+        # Data beyond our current stream position must first be consumed.
+        elif self.position >= self.stream_position:
+            self.skip_to(self.position)
+            if end is None:
+                contents = self.stream.read()
+            else:
+                contents = self.read_stream(end - self.position)
+            self.retain(self.position, contents)
+            self.stream_position += len(contents)
+            self.position += len(contents)
+            return contents
+
+        # Otherwise, we're revisiting data we've already consumed.
+        if end is None or end > self.stream_position:
+            # Ensure everything requested has been read.
+            previous_position = self.position
+            self.position = self.stream_position
+            self.read(-1 if end is None else end - self.stream_position)
+            self.position = previous_position
+            end = self.stream_position if end is None else min(end, self.stream_position)
+
+        contents = self.read_retained(self.position, end)
+        self.position += len(contents)
+        return contents
+
+    def read_stream(self, size: int) -> bytes:
+        """Reads exactly the given size from our stream, unless it ends."""
+        contents = self.stream.read(size)
+        if len(contents) == size or not contents:
+            return contents
+
+        # Pipes may return less than requested.
+        parts = [contents]
+        remaining = size - len(contents)
+        while remaining:
+            part = self.stream.read(remaining)
+            if not part:
+                break
+            parts.append(part)
+            remaining -= len(part)
+        return b"".join(parts)
+
+    def skip_to(self, target: Optional[int]):
+        """Consumes the stream up to the target offset (or its end if None),
+        retaining or discarding skipped data as necessary."""
+        while target is None or self.stream_position < target:
+            read_size = SKIP_READ_SIZE
+            if target is not None:
+                read_size = min(read_size, target - self.stream_position)
+
+            # Avoid splitting a declared region across multiple pieces,
+            # so that its contents can be returned without copying.
+            region = self.find_region(self.stream_position)
+            if region is not None:
+                region_start, region_end = region
+                if region_start > self.stream_position:
+                    read_size = min(read_size, region_start - self.stream_position)
+                elif self.budget is not None:
+                    # Regions are buffered in portions, as they may spill to disk.
+                    read_size = min(read_size, region_end - self.stream_position)
+                elif target is None or region_end <= target:
+                    read_size = region_end - self.stream_position
+
+            contents = self.read_stream(read_size)
+            if not contents:
+                break
+
+            self.handle_skipped(self.stream_position, contents)
+            self.stream_position += len(contents)
+
+    def find_region(self, offset: int) -> Optional[tuple[int, int]]:
+        """Returns the first declared region ending after the given offset."""
+        if self.regions is None:
+            return None
+        index = bisect.bisect_right(self.regions, (offset, float("inf")))
+        if index > 0 and self.regions[index - 1][1] > offset:
+            return self.regions[index - 1]
+        if index < len(self.regions):
+            return self.regions[index]
+        return None
+
+    def handle_skipped(self, start: int, contents: bytes):
+        end = start + len(contents)
+
+        if self.regions is None:
+            # We don't know what will be needed, so we must spill this.
+            if self.spill is None:
+                self.spill = tempfile.SpooledTemporaryFile(
+                    max_size=SPILL_MEMORY_LIMIT
+                )
+            self.spill.seek(0, io.SEEK_END)
+            self.add_piece(start, len(contents), self.spill.tell())
+            self.spill.write(contents)
+            return
+
+        # Retain only what falls within declared regions.
+        for region_start, region_end in self.regions:
+            if region_end <= start:
+                continue
+            if region_start >= end:
+                break
+            overlap_start = max(start, region_start)
+            overlap_end = min(end, region_end)
+            if self.budget is not None:
+                self.buffer_region(
+                    region_start,
+                    region_end,
+                    contents[overlap_start - start : overlap_end - start],
+                )
+            elif overlap_start == start and overlap_end == end:
+                self.retain(start, contents)
+            else:
+                self.retain(
+                    overlap_start,
+                    contents[overlap_start - start : overlap_end - start],
+                )
+
+    def buffer_region(self, region_start: int, region_end: int, contents: bytes):
+        region_length = region_end - region_start
+        buffer = self.region_buffers.get(region_start)
+        if buffer is None:
+            buffer = self.budget.buffer(region_length)
+            self.region_buffers[region_start] = buffer
+        buffer.write(contents)
+
+        # Once complete, our region can be read back.
+        if buffer.size == region_length:
+            self.budget.record(buffer)
+            self.add_piece(region_start, region_length, buffer.getbuffer())
+            del self.region_buffers[region_start]
+
+    def retain(self, start: int, contents: bytes):
+        if contents:
+            self.add_piece(start, len(contents), contents)
+
+    def add_piece(self, start: int, length: int, data: object):
+        index = bisect.bisect_right(self.piece_starts, start)
+        self.piece_starts.insert(index, start)
+        self.pieces.insert(index, (start, length, data))
+
+    def read_retained(self, start: int, end: int) -> bytes:
+        """Reassembles previously consumed data from retained pieces."""
+        index = bisect.bisect_right(self.piece_starts, start) - 1
+        parts = []
+        position = start
+        while position < end:
+            if index < 0 or index >= len(self.pieces):
+                break
+            piece_start, piece_length, data = self.pieces[index]
+            piece_end = piece_start + piece_length
+            if piece_start > position:
+                break
+            if piece_end <= position:
+                index += 1
+                continue
+
+            # Avoid copies when an entire piece is requested.
+            if piece_start == start and piece_end == end and not isinstance(data, int):
+                return data
+
+            slice_end = min(end, piece_end)
+            if isinstance(data, memoryview):
+                parts.append(
+                    bytes(data[position - piece_start : slice_end - piece_start])
+                )
+            elif isinstance(data, bytes):
+                parts.append(data[position - piece_start : slice_end - piece_start])
+            else:
+                self.spill.seek(data + position - piece_start)
+                parts.append(self.spill.read(slice_end - position))
+            position = slice_end
+            index += 1
+
+        if position < end:
+            raise io.UnsupportedOperation(
+                f"Data at offset {position:#x} was not retained from a forward-only stream"
+            )
+        return b"".join(parts)
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+        super().close()
+
+
+def iterate_paths(paths: Iterable[pathlib.Path]):
+    """Yields all files within the given paths, descending into directories."""
+    for path in paths:
+        if path.is_dir():
+            yield from sorted(p for p in path.rglob("*") if p.is_file())
+        else:
+            yield path
+
+
+def open_source(
+    path: str, member: Optional[str] = None, budget: Optional[MemoryBudget] = None
+) -> BinaryIO:
+    """Opens a SuperBinary from the given path, or from standard input via "-".
+
+    If a member is given, the path is treated as a zip or tar archive,
+    and the SuperBinary is read directly from the named member."""
+    if member is None:
+        if path == "-":
+            return sys.stdin.buffer
+        return open(path, "rb")
+
+    if path != "-" and zipfile.is_zipfile(path):
+        archive = zipfile.ZipFile(path)
+        member_file = archive.open(member)
+        if archive.getinfo(member).compress_type == zipfile.ZIP_STORED:
+            # Stored members can be seeked cheaply.
+            return member_file
+        # Seeking backwards within compressed members restarts decompression.
+        return ForwardReader(member_file, budget)
+
+    # Tar archives are read in streaming mode, permitting pipes and compression.
+    source = sys.stdin.buffer if path == "-" else open(path, "rb")
+    archive = tarfile.open(fileobj=source, mode="r|*")
+    for tar_member in archive:
+        if tar_member.name == member or tar_member.name == f"./{member}":
+            member_file = archive.extractfile(tar_member)
+            if member_file is None:
+                raise AssertionError(f"Archive member {member} is not a file!")
+            return ForwardReader(member_file, budget)
+
+    raise AssertionError(f"Unable to find {member} within archive!")
@@ -1,10 +1,13 @@
-import io
+import fnmatch
 import struct
 from dataclasses import dataclass, field
-from typing import Optional
+from typing import BinaryIO, Callable, Iterable, Optional
 
+from events import EventEmitter, PayloadFound
+from memory import MemoryBudget
 from metadata_plist import MetadataPlist, UarpMetadata
-from uarp_payload import UarpPayload
+from source import ForwardReader
+from uarp_payload import UarpPayload, get_payload_regions
 
 
 @dataclass
@@ -41,9 +44,43 @@ class SuperBinary(object):
     raw_plist_data: bytes = field(repr=False)
     # The unarchived, top-level SuperBinary plist.
     metadata: MetadataPlist
-
-    def __init__(self, data: io.BufferedReader):
+    # Payloads by their tag, in order of appearance. Tags may repeat.
+    tag_index: dict[bytes, list[UarpPayload]] = field(repr=False)
+    # Payloads by their plist filepath, in order of appearance.
+    path_index: dict[str, list[UarpPayload]] = field(repr=False)
+
+    def __init__(
+        self,
+        data: BinaryIO,
+        budget: Optional[MemoryBudget] = None,
+        select: Optional[Callable[[UarpPayload], bool]] = None,
+        events: Optional[EventEmitter] = None,
+        select_tag: Optional[Callable[[bytes], bool]] = None,
+    ):
+        """Parses the given SuperBinary.
+
+        If `select` is given, only payloads for which it returns True have their
+        contents read; all others have None as their contents.
+
+        Forward-only streams present the plist last, so `select` cannot be
+        consulted until every payload has been streamed past. Payloads must
+        therefore be buffered unless they are excluded by `select_tag`,
+        which is given each row's tag before any payload is reached.
+        Payloads it rejects are discarded from forward-only streams and are
+        never read. Selection by plist metadata (such as filepath) cannot
+        avoid buffering forward-only streams."""
         self.payloads = []
+        self.tag_index = {}
+        self.path_index = {}
+
+        # With a memory budget, files are mapped rather than read.
+        if budget is not None:
+            data = budget.map_source(data)
+
+        # Forward-only streams (such as pipes, or compressed archive members)
+        # need to retain the regions we revisit.
+        if not isinstance(data, ForwardReader) and not data.seekable():
+            data = ForwardReader(data, budget)
 
         # Ensure the version and size initially to ensure this file is correct.
         self.header_version, self.header_length = struct.unpack_from(
@@ -70,6 +107,34 @@ class SuperBinary(object):
         ) = struct.unpack_from(">IIII", data.read(16))
 
         # At this point, we have gone past the SuperBinary header (0x2c).
+        # Our payload metadata immediately follows.
+        data.seek(self.header_length)
+        raw_rows = data.read(self.row_length)
+
+        # The observed tag size is 0x28, so we will assume that.
+        # Please make an issue (or a PR) to change this logic in the future!
+        metadata_tag_size = 0x28
+        if raw_rows:
+            queried_data = struct.unpack_from(">I", raw_rows)
+            assert queried_data[0] == metadata_tag_size, "Unknown metadata tag size!"
+        row_count = self.row_length // metadata_tag_size
+        payload_headers = [
+            raw_rows[offset : offset + metadata_tag_size]
+            for offset in range(0, row_count * metadata_tag_size, metadata_tag_size)
+        ]
+
+        # Forward-only streams can now discard everything but selected payloads.
+        # Our tag is the second field of each row.
+        if isinstance(data, ForwardReader):
+            data.declare_regions(
+                [
+                    region
+                    for payload_header in payload_headers
+                    if select_tag is None or select_tag(bytes(payload_header[4:8]))
+                    for region in get_payload_regions(payload_header)
+                ]
+            )
+
         # Our binary plist is at the end of our payload (`binary_size`).
         # Let's read it, and then jump back.
         data.seek(self.binary_size)
@@ -78,15 +143,6 @@ class SuperBinary(object):
         # Unarchive the SuperBinary plist.
         self.metadata = MetadataPlist(self.raw_plist_data)
 
-        # Jump back to where we left off, and finally extract actual payload metadata.
-        data.seek(0x2C)
-        # The observed tag size is 0x28, so we will assume that.
-        # Please make an issue (or a PR) to change this logic in the future!
-        queried_data = struct.unpack_from(">I", data.peek(4))
-        metadata_tag_size = queried_data[0]
-        assert metadata_tag_size == 0x28, "Unknown metadata tag size!"
-        row_count = self.row_length // metadata_tag_size
-
         # TODO(spotlightishere): Is there any condition
         # in which the length of the payload metadata array
         # will not match the count of actual payloads?
@@ -95,21 +151,71 @@ class SuperBinary(object):
         ), "Mismatched payload count between binary and metadata!"
 
         # Obtain the metadata for all possible payloads.
-        for payload_num in range(row_count):
-            # Determine the metadata offset for this payload.
-            offset = self.header_length + (payload_num * metadata_tag_size)
-            data.seek(offset)
-            payload_metadata = data.read(metadata_tag_size)
-
+        for payload_num, payload_metadata in enumerate(payload_headers):
             # This is a tuple with [tag, UarpMetadata].
             plist_tuple = self.metadata.payload_tags[payload_num]
-            payload = UarpPayload(payload_metadata, plist_tuple, data)
+            payload = UarpPayload(payload_metadata, plist_tuple)
+            selected = (select_tag is None or select_tag(payload.tag)) and (
+                select is None or select(payload)
+            )
+            if selected:
+                payload.read(data)
+
+            if events is not None:
+                events.emit(
+                    PayloadFound(
+                        payload.get_tag(),
+                        payload_num,
+                        payload.plist_metadata.filepath,
+                        payload.payloads_length,
+                        selected,
+                    )
+                )
+
             self.payloads.append(payload)
+            self.tag_index.setdefault(payload.tag, []).append(payload)
+            self.path_index.setdefault(payload.plist_metadata.filepath, []).append(
+                payload
+            )
 
     def get_tag(self, tag: bytes) -> Optional[UarpPayload]:
-        """Returns the payload for the given tag. Returns None if not present."""
+        """Returns the first payload for the given tag. Returns None if not present."""
+        payloads = self.get_tags(tag)
+        if not payloads:
+            return None
+        return payloads[0]
+
+    def get_tags(self, tag: bytes) -> list[UarpPayload]:
+        """Returns all payloads for the given tag, in order of appearance."""
         assert len(tag) == 4, "Invalid 4CC/magic passed!"
-        for payload in self.payloads:
-            if payload.tag == tag:
-                return payload
-        return None
+        return self.tag_index.get(tag, [])
+
+    def get_paths(self, pattern: str) -> list[UarpPayload]:
+        """Returns all payloads whose plist filepath matches the given glob."""
+        # Exact paths can be looked up directly.
+        if not any(character in pattern for character in "*?["):
+            return self.path_index.get(pattern, [])
+
+        return [
+            payload
+            for payload in self.payloads
+            if payload.plist_metadata.filepath is not None
+            and fnmatch.fnmatchcase(payload.plist_metadata.filepath, pattern)
+        ]
+
+
+def number_repeated(names: Iterable[str]) -> list[str]:
+    """Makes the given payload names unique, in order.
+
+    Sometimes, tags have multiple payloads, and filepaths conflict.
+    Each repeated name has its count appended, so that three payloads named
+    `FOTA.bin` become `FOTA.bin`, `FOTA.bin.1` and `FOTA.bin.2`."""
+    seen_names: dict[str, int] = {}
+    numbered_names = []
+    for name in names:
+        seen_count = seen_names.get(name)
+        seen_names[name] = (seen_count or 0) + 1
+        if seen_count is not None:
+            name = f"{name}.{seen_count}"
+        numbered_names.append(name)
+    return numbered_names
@@ -1,9 +1,22 @@
 import io
 import struct
 from dataclasses import dataclass, field
+from typing import Optional
 from metadata_plist import UarpMetadata
 
 
+def get_payload_regions(header: bytes) -> list[(int, int)]:
+    """Returns the (offset, length) regions a payload header refers to,
+    without fully parsing it."""
+    (
+        metadata_offset,
+        metadata_length,
+        payloads_offset,
+        payloads_length,
+    ) = struct.unpack_from(">IIII", header, 0x18)
+    return [(metadata_offset, metadata_length), (payloads_offset, payloads_length)]
+
+
 @dataclass
 class UarpPayload(object):
     # The tag representing this payload, i.e. 'FOTA'.
@@ -26,17 +39,19 @@ class UarpPayload(object):
     payloads_offset: int
     # Binary metadata held by the current payload.
     # Note that, in some firmware, it may be empty.
-    metadata: bytes = field(repr=False)
+    # This is None if this payload's contents have not been read.
+    metadata: Optional[bytes] = field(repr=False)
     # Metadata specified for this payload within the SuperBinary plist.
     plist_metadata: UarpMetadata
     # The data represented by this payload.
-    contents: bytes = field(repr=False)
+    # This is None if this payload's contents have not been read.
+    contents: Optional[bytes] = field(repr=False)
 
     def __init__(
         self,
         header: bytes,
         plist_tuple: (bytes, UarpMetadata),
-        data: io.BufferedReader,
+        data: Optional[io.BufferedReader] = None,
     ):
         # Parse the metadata within header.
         (
@@ -58,7 +73,13 @@ class UarpPayload(object):
         assert plist_tag == self.tag, "Mismatched tag between payload and metadata!"
         self.plist_metadata = plist_metadata
 
-        # Obtain our metadata and payload.
+        self.metadata = None
+        self.contents = None
+        if data is not None:
+            self.read(data)
+
+    def read(self, data: io.BufferedReader):
+        """Reads this payload's metadata and contents from the given SuperBinary."""
         data.seek(self.metadata_offset)
         self.metadata = data.read(self.metadata_length)
 
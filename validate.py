@@ -0,0 +1,490 @@
+import argparse
+import io
+import json
+import pathlib
+import struct
+import sys
+from dataclasses import dataclass
+from enum import Enum
+from typing import BinaryIO, Optional
+
+from compressed_payload import ChunkError, ChunkErrorKind, walk_chunks
+from fota_payload import (
+    FotaMetadataError,
+    FotaMetadataType,
+    FotaSegmentArray,
+    get_lzma_declared_size,
+    walk_fota_tlvs,
+)
+from metadata_plist import MetadataPlist
+from source import iterate_paths
+
+# The SuperBinary header is always 0x2C bytes in length.
+SUPER_BINARY_HEADER_LENGTH = 0x2C
+# The only observed payload row size.
+PAYLOAD_ROW_LENGTH = 0x28
+# FOTA metadata is 4096 bytes in length, followed by its LZMA payload.
+FOTA_METADATA_LENGTH = 0x1000
+# The length of a legacy .lzma ("LZMA alone") header.
+LZMA_ALONE_HEADER_LENGTH = 13
+
+
+class ValidationCode(Enum):
+    """Structural problems that can be detected without decoding payloads."""
+
+    TRUNCATED_HEADER = "truncated-header"
+    UNKNOWN_VERSION = "unknown-version"
+    INVALID_HEADER_LENGTH = "invalid-header-length"
+    BINARY_SIZE_OUT_OF_BOUNDS = "binary-size-out-of-bounds"
+    MISSING_PLIST = "missing-plist"
+    ROW_TABLE_OUT_OF_BOUNDS = "row-table-out-of-bounds"
+    UNKNOWN_ROW_SIZE = "unknown-row-size"
+    MISALIGNED_ROW_TABLE = "misaligned-row-table"
+    METADATA_OUT_OF_BOUNDS = "metadata-out-of-bounds"
+    PAYLOAD_OUT_OF_BOUNDS = "payload-out-of-bounds"
+    OVERLAPPING_REGIONS = "overlapping-regions"
+    INVALID_PLIST = "invalid-plist"
+    ROW_COUNT_MISMATCH = "row-count-mismatch"
+    TAG_MISMATCH = "tag-mismatch"
+    UNKNOWN_COMPRESSION_TYPE = "unknown-compression-type"
+    INVALID_PASSTHROUGH_CHUNK = "invalid-passthrough-chunk"
+    CHUNK_OUT_OF_BOUNDS = "chunk-out-of-bounds"
+    DISCONTIGUOUS_CHUNK = "discontiguous-chunk"
+    CHUNK_WALK_MISMATCH = "chunk-walk-mismatch"
+    FOTA_TRUNCATED = "fota-truncated"
+    FOTA_TLV_OUT_OF_BOUNDS = "fota-tlv-out-of-bounds"
+    FOTA_UNKNOWN_LZMA_FORMAT = "fota-unknown-lzma-format"
+    FOTA_SEGMENT_OUT_OF_BOUNDS = "fota-segment-out-of-bounds"
+
+
+# How problems found while walking chunks are reported.
+CHUNK_ERROR_CODES = {
+    ChunkErrorKind.OUT_OF_BOUNDS: ValidationCode.CHUNK_OUT_OF_BOUNDS,
+    ChunkErrorKind.UNKNOWN_COMPRESSION_TYPE: ValidationCode.UNKNOWN_COMPRESSION_TYPE,
+    ChunkErrorKind.INVALID_PASSTHROUGH: ValidationCode.INVALID_PASSTHROUGH_CHUNK,
+    ChunkErrorKind.DISCONTIGUOUS: ValidationCode.DISCONTIGUOUS_CHUNK,
+}
+
+
+@dataclass
+class ValidationIssue(object):
+    """A single structural problem found within a SuperBinary."""
+
+    code: ValidationCode
+    message: str
+    # The absolute offset within the SuperBinary this issue refers to, if any.
+    offset: Optional[int] = None
+    # The tag of the payload this issue refers to, if any.
+    tag: Optional[bytes] = None
+
+    def to_dict(self) -> dict:
+        """Returns a JSON-serializable representation of this issue."""
+        return {
+            "code": self.code.value,
+            "message": self.message,
+            "offset": self.offset,
+            "tag": self.tag.decode("utf-8", "replace") if self.tag else None,
+        }
+
+
+@dataclass
+class _Row(object):
+    """The subset of a payload row we need for validation."""
+
+    tag: bytes
+    metadata_offset: int
+    metadata_length: int
+    payloads_offset: int
+    payloads_length: int
+
+
+class _FileRegion(object):
+    """A region of the file being validated, read only upon slicing."""
+
+    def __init__(self, validator: "_Validator", offset: int, length: int):
+        self.validator = validator
+        self.offset = offset
+        self.length = length
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, index: slice) -> bytes:
+        start, stop, _ = index.indices(self.length)
+        return self.validator.read_at(self.offset + start, stop - start)
+
+
+class _Validator(object):
+    """Walks the structure of a SuperBinary, recording issues as it goes."""
+
+    def __init__(self, data: BinaryIO):
+        self.data = data
+        self.issues: list[ValidationIssue] = []
+
+        data.seek(0, io.SEEK_END)
+        self.file_size = data.tell()
+
+    def report(
+        self,
+        code: ValidationCode,
+        message: str,
+        offset: Optional[int] = None,
+        tag: Optional[bytes] = None,
+    ):
+        self.issues.append(ValidationIssue(code, message, offset, tag))
+
+    def read_at(self, offset: int, length: int) -> bytes:
+        self.data.seek(offset)
+        return self.data.read(length)
+
+    def validate(self):
+        if self.file_size < SUPER_BINARY_HEADER_LENGTH:
+            self.report(
+                ValidationCode.TRUNCATED_HEADER,
+                f"File is {self.file_size} bytes, smaller than the SuperBinary header",
+                0,
+            )
+            return
+
+        (
+            header_version,
+            header_length,
+            binary_size,
+            _major_version,
+            _minor_version,
+            _release_version,
+            _build_version,
+            _metadata_offset,
+            _metadata_length,
+            _row_offset,
+            row_length,
+        ) = struct.unpack(">IIIIIIIIIII", self.read_at(0, SUPER_BINARY_HEADER_LENGTH))
+
+        if header_version not in [2, 3]:
+            self.report(
+                ValidationCode.UNKNOWN_VERSION,
+                f"Unknown SuperBinary version {header_version}",
+                0,
+            )
+            return
+        if header_length != SUPER_BINARY_HEADER_LENGTH:
+            self.report(
+                ValidationCode.INVALID_HEADER_LENGTH,
+                f"Header length is {header_length:#x}, expected {SUPER_BINARY_HEADER_LENGTH:#x}",
+                4,
+            )
+            return
+        if binary_size > self.file_size:
+            self.report(
+                ValidationCode.BINARY_SIZE_OUT_OF_BOUNDS,
+                f"Binary size {binary_size:#x} exceeds file size {self.file_size:#x}",
+                8,
+            )
+            return
+        if binary_size == self.file_size:
+            self.report(
+                ValidationCode.MISSING_PLIST,
+                "No trailing SuperBinary plist is present",
+                binary_size,
+            )
+
+        # As with SuperBinary, payload rows immediately follow the header.
+        rows_end = header_length + row_length
+        if rows_end > binary_size:
+            self.report(
+                ValidationCode.ROW_TABLE_OUT_OF_BOUNDS,
+                f"Row table ends at {rows_end:#x}, past binary size {binary_size:#x}",
+                header_length,
+            )
+            return
+        if row_length % PAYLOAD_ROW_LENGTH != 0:
+            self.report(
+                ValidationCode.MISALIGNED_ROW_TABLE,
+                f"Row table length {row_length:#x} is not a multiple of {PAYLOAD_ROW_LENGTH:#x}",
+                header_length,
+            )
+
+        rows = self.validate_rows(header_length, row_length, binary_size)
+        if rows is None:
+            return
+
+        chunk_sizes = self.validate_plist(rows, binary_size)
+        if chunk_sizes is not None:
+            for row, chunk_size in zip(rows, chunk_sizes):
+                if chunk_size:
+                    self.validate_chunks(row, chunk_size)
+        self.validate_fota(rows)
+
+    def validate_rows(
+        self, header_length: int, row_length: int, binary_size: int
+    ) -> Optional[list[_Row]]:
+        row_count = row_length // PAYLOAD_ROW_LENGTH
+        raw_rows = self.read_at(header_length, row_count * PAYLOAD_ROW_LENGTH)
+
+        rows = []
+        for row_num in range(row_count):
+            row_offset = header_length + row_num * PAYLOAD_ROW_LENGTH
+            (
+                row_size,
+                tag,
+                _major_version,
+                _minor_version,
+                _release_version,
+                _build_version,
+                metadata_offset,
+                metadata_length,
+                payloads_offset,
+                payloads_length,
+            ) = struct.unpack_from(
+                ">I4sIIIIIIII", raw_rows, row_num * PAYLOAD_ROW_LENGTH
+            )
+            if row_size != PAYLOAD_ROW_LENGTH:
+                self.report(
+                    ValidationCode.UNKNOWN_ROW_SIZE,
+                    f"Row {row_num} has unknown size {row_size:#x}",
+                    row_offset,
+                )
+                return None
+
+            rows.append(
+                _Row(tag, metadata_offset, metadata_length, payloads_offset, payloads_length)
+            )
+
+        # Every region must sit between the row table and the plist.
+        data_start = header_length + row_length
+        regions = []
+        for row in rows:
+            if not self.in_bounds(
+                row.metadata_offset, row.metadata_length, data_start, binary_size
+            ):
+                self.report(
+                    ValidationCode.METADATA_OUT_OF_BOUNDS,
+                    f"Metadata [{row.metadata_offset:#x}, +{row.metadata_length:#x}) is out of bounds",
+                    row.metadata_offset,
+                    row.tag,
+                )
+            elif row.metadata_length:
+                regions.append((row.metadata_offset, row.metadata_length, row.tag))
+
+            if not self.in_bounds(
+                row.payloads_offset, row.payloads_length, data_start, binary_size
+            ):
+                self.report(
+                    ValidationCode.PAYLOAD_OUT_OF_BOUNDS,
+                    f"Payload [{row.payloads_offset:#x}, +{row.payloads_length:#x}) is out of bounds",
+                    row.payloads_offset,
+                    row.tag,
+                )
+            elif row.payloads_length:
+                regions.append((row.payloads_offset, row.payloads_length, row.tag))
+
+        # Sorting by offset means any overlap must be with the previous region.
+        regions.sort()
+        for (prev_offset, prev_length, prev_tag), (offset, _, tag) in zip(
+            regions, regions[1:]
+        ):
+            if offset < prev_offset + prev_length:
+                self.report(
+                    ValidationCode.OVERLAPPING_REGIONS,
+                    f"Region at {offset:#x} overlaps {prev_tag!r} at {prev_offset:#x}",
+                    offset,
+                    tag,
+                )
+
+        return rows
+
+    def validate_plist(
+        self, rows: list[_Row], binary_size: int
+    ) -> Optional[list[Optional[int]]]:
+        """Ensures the plist matches our rows, returning each row's chunk size."""
+        raw_plist = self.read_at(binary_size, self.file_size - binary_size)
+        try:
+            metadata = MetadataPlist(raw_plist)
+        except Exception as e:
+            self.report(
+                ValidationCode.INVALID_PLIST,
+                f"Unable to unarchive SuperBinary plist: {e!r}",
+                binary_size,
+            )
+            return None
+
+        if len(metadata.payload_tags) != len(rows):
+            self.report(
+                ValidationCode.ROW_COUNT_MISMATCH,
+                f"{len(rows)} payload rows, but {len(metadata.payload_tags)} plist payloads",
+            )
+            return None
+
+        for row, (plist_tag, _) in zip(rows, metadata.payload_tags):
+            if row.tag != plist_tag:
+                self.report(
+                    ValidationCode.TAG_MISMATCH,
+                    f"Row tag {row.tag!r} does not match plist tag {plist_tag!r}",
+                    tag=row.tag,
+                )
+
+        # Chunk walks need to know which payloads are compressed.
+        return [
+            plist_metadata.compressed_chunk_size
+            for _, plist_metadata in metadata.payload_tags
+        ]
+
+    def validate_chunks(self, row: _Row, chunk_size: int):
+        """Walks chunk headers, ensuring they end exactly at the payload's end."""
+        payload_end = row.payloads_offset + row.payloads_length
+        if payload_end > self.file_size:
+            # This has already been reported as out of bounds.
+            return
+
+        # Only chunk headers are read from our payload.
+        payload = _FileRegion(self, row.payloads_offset, row.payloads_length)
+        try:
+            for header in walk_chunks(payload, chunk_size):
+                chunks_end = header.end
+        except ChunkError as e:
+            self.report(
+                CHUNK_ERROR_CODES[e.kind], str(e), row.payloads_offset + e.offset, row.tag
+            )
+            return
+
+        if chunks_end != row.payloads_length:
+            self.report(
+                ValidationCode.CHUNK_WALK_MISMATCH,
+                f"Chunks end at {row.payloads_offset + chunks_end:#x}, but payload ends at {payload_end:#x}",
+                row.payloads_offset + chunks_end,
+                row.tag,
+            )
+
+    def validate_fota(self, rows: list[_Row]):
+        """Ensures FOTA TLVs and segments fit within the declared LZMA size."""
+        for row in rows:
+            if row.tag != b"FOTA":
+                continue
+            if row.payloads_offset + row.payloads_length > self.file_size:
+                continue
+
+            if row.payloads_length < FOTA_METADATA_LENGTH + LZMA_ALONE_HEADER_LENGTH:
+                self.report(
+                    ValidationCode.FOTA_TRUNCATED,
+                    f"FOTA payload is only {row.payloads_length:#x} bytes",
+                    row.payloads_offset,
+                    row.tag,
+                )
+                continue
+
+            raw_metadata = self.read_at(
+                row.payloads_offset, FOTA_METADATA_LENGTH + LZMA_ALONE_HEADER_LENGTH
+            )
+            segments = self.read_fota_segments(row, raw_metadata[:FOTA_METADATA_LENGTH])
+            if segments is None:
+                continue
+
+            lzma_header = raw_metadata[FOTA_METADATA_LENGTH:]
+            # xz streams start with their own magic; only LZMA alone declares
+            # its size upfront. Its first byte (lc/lp/pb) must be below 225.
+            if lzma_header[0] >= 225:
+                self.report(
+                    ValidationCode.FOTA_UNKNOWN_LZMA_FORMAT,
+                    "FOTA payload is not an LZMA alone stream",
+                    row.payloads_offset + FOTA_METADATA_LENGTH,
+                    row.tag,
+                )
+                continue
+            declared_size = get_lzma_declared_size(lzma_header)
+            if declared_size is None:
+                continue
+
+            for index, (segment_offset, segment_length) in enumerate(segments):
+                # Segment offsets are 0x1000 ahead of the decompressed image.
+                start = segment_offset - FOTA_METADATA_LENGTH
+                if start < 0 or start + segment_length > declared_size:
+                    self.report(
+                        ValidationCode.FOTA_SEGMENT_OUT_OF_BOUNDS,
+                        f"Segment {index} [{start:#x}, +{segment_length:#x}) exceeds "
+                        f"decompressed size {declared_size:#x}",
+                        row.payloads_offset,
+                        row.tag,
+                    )
+
+    def read_fota_segments(
+        self, row: _Row, raw_metadata: bytes
+    ) -> Optional[list[tuple[int, int]]]:
+        """Returns the (offset, length) of each segment within FOTA metadata,
+        or None if its TLVs are malformed."""
+        segments = []
+        try:
+            for data_type, position, contents in walk_fota_tlvs(raw_metadata):
+                if data_type != FotaMetadataType.SEGMENT_METADATA:
+                    continue
+                try:
+                    segment_array = FotaSegmentArray(contents)
+                except AssertionError as e:
+                    raise FotaMetadataError(str(e), position)
+                for segment in segment_array.segments:
+                    segments.append((segment.payload_offset, segment.payload_length))
+        except FotaMetadataError as e:
+            self.report(
+                ValidationCode.FOTA_TLV_OUT_OF_BOUNDS,
+                str(e),
+                row.payloads_offset + e.offset,
+                row.tag,
+            )
+            return None
+        return segments
+
+    @staticmethod
+    def in_bounds(offset: int, length: int, start: int, end: int) -> bool:
+        # Empty regions refer to nothing, regardless of their offset.
+        # (Metadata, for example, has been observed at offset zero.)
+        if length == 0:
+            return True
+        return start <= offset and offset + length <= end
+
+
+def validate_super_binary(data: BinaryIO) -> list[ValidationIssue]:
+    """Checks the structure of a SuperBinary without decoding any payloads.
+
+    Only the header, payload rows, plist, chunk headers and FOTA metadata are read.
+    An empty list is returned if no issues were found."""
+    validator = _Validator(data)
+    validator.validate()
+    return validator.issues
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Validates the structure of SuperBinaries without extracting them."
+    )
+    parser.add_argument(
+        "paths",
+        help="SuperBinaries, or directories containing them, to validate.",
+        nargs="+",
+        type=pathlib.Path,
+    )
+    parser.add_argument(
+        "--json",
+        help="Whether to emit one JSON object per file instead of text.",
+        action=argparse.BooleanOptionalAction,
+    )
+    args = parser.parse_args()
+
+    failed = False
+    for path in iterate_paths(args.paths):
+        with open(path, "rb") as f:
+            issues = validate_super_binary(f)
+        failed = failed or bool(issues)
+
+        if args.json:
+            result = {
+                "path": str(path),
+                "valid": not issues,
+                "issues": [issue.to_dict() for issue in issues],
+            }
+            print(json.dumps(result))
+        elif not issues:
+            print(f"{path}: OK")
+        else:
+            for issue in issues:
+                print(f"{path}: {issue.code.value}: {issue.message}")
+
+    sys.exit(1 if failed else 0)
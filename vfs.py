@@ -0,0 +1,324 @@
+import argparse
+import sys
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import BinaryIO, Callable, Optional
+
+from compressed_payload import decompress_chunks, read_chunks
+from events import EventEmitter
+from fota_payload import (
+    FotaMetadata,
+    FotaPayload,
+    FotaSegment,
+    get_lzma_declared_size,
+)
+from memory import BufferReader, MemoryBudget, parse_size
+from rofs import ROFS, find_rofs
+from source import open_source
+from super_binary import SuperBinary, number_repeated
+from uarp_payload import UarpPayload
+
+# By default, resolved layers totalling up to this size are cached.
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+
+
+@dataclass
+class VirtualStat(object):
+    """Information about a path within a VirtualFS."""
+
+    is_dir: bool
+    # The size of this file's contents. Directories have their entry count.
+    size: int
+
+
+class VirtualFS(object):
+    """A lazy, read-only view over the contents of a SuperBinary.
+
+    Paths are resolved layer by layer on first access:
+     - `SuperBinary.plist`
+     - `<TAG>/raw`, the payload as stored (repeated tags are numbered via `number_repeated`)
+     - `<TAG>/decompressed`, for chunk-compressed payloads
+     - `FOTA/compressed`, `FOTA/decompressed`, `FOTA/segments/<n>` and `FOTA/rofs/<file>`
+
+    Resolved layers (payload contents, decompressed buffers, parsed partitions)
+    are cached, with the least recently used evicted beyond `cache_size` bytes.
+    Layers are views of their parent where possible. As a cached child keeps
+    its parent's memory alive even once its parent is evicted, children are
+    counted at their parent's size."""
+
+    def __init__(
+        self,
+        data: BinaryIO,
+        budget: Optional[MemoryBudget] = None,
+        events: Optional[EventEmitter] = None,
+        cache_size: int = DEFAULT_CACHE_SIZE,
+    ):
+        self.budget = budget
+        self.events = events
+        self.cache_size = cache_size
+        self.cache: OrderedDict[tuple, tuple[object, int]] = OrderedDict()
+        self.cache_bytes = 0
+        # Layers depend on each other, so resolution may re-enter.
+        self.lock = threading.RLock()
+
+        # Payloads within seekable sources are only read upon access.
+        # Forward-only sources must be read in full while parsing.
+        if budget is not None:
+            data = budget.map_source(data)
+        self.lazy = data.seekable()
+        self.data = data
+        self.super_binary = SuperBinary(
+            data, budget, select=(lambda _: False) if self.lazy else None, events=events
+        )
+
+        payloads = self.super_binary.payloads
+        tag_names = number_repeated(payload.get_tag() for payload in payloads)
+        self.payloads: dict[str, UarpPayload] = dict(zip(tag_names, payloads))
+
+    def cached(self, key: tuple, resolve: Callable[[], object], get_size=len) -> object:
+        """Returns the cached layer for the given key, resolving it if necessary."""
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key][0]
+
+            value = resolve()
+            size = get_size(value)
+            self.cache[key] = (value, size)
+            self.cache_bytes += size
+
+            # Evict the least recently used, always retaining what we just resolved.
+            while self.cache_bytes > self.cache_size and len(self.cache) > 1:
+                _, (_, evicted_size) = self.cache.popitem(last=False)
+                self.cache_bytes -= evicted_size
+            return value
+
+    def get_payload(self, name: str) -> UarpPayload:
+        payload = self.payloads.get(name)
+        if payload is None:
+            raise FileNotFoundError(f"No payload named {name}")
+        return payload
+
+    def get_raw(self, name: str) -> bytes:
+        payload = self.get_payload(name)
+        if not self.lazy:
+            return payload.contents
+
+        def read_raw() -> bytes:
+            self.data.seek(payload.payloads_offset)
+            return self.data.read(payload.payloads_length)
+
+        return self.cached(("raw", name), read_raw)
+
+    def read_prefix(self, name: str, length: int) -> bytes:
+        """Returns a copy of the start of the given payload, without reading
+        (or keeping alive) the remainder."""
+        with self.lock:
+            if self.lazy and ("raw", name) not in self.cache:
+                self.data.seek(self.get_payload(name).payloads_offset)
+                return bytes(self.data.read(length))
+            return bytes(self.get_raw(name)[0:length])
+
+    def is_fota(self, name: str) -> bool:
+        return self.get_payload(name).tag == b"FOTA"
+
+    def get_fota_metadata(self, name: str) -> FotaMetadata:
+        # Metadata alone does not require decompression, nor reading our entire payload.
+        # It is copied, so that it does not keep our payload alive.
+        def read_metadata() -> FotaMetadata:
+            return FotaMetadata(self.read_prefix(name, 0x1000))
+
+        return self.cached(("fota_metadata", name), read_metadata, lambda _: 0x1000)
+
+    def get_fota_decompressed(self, name: str) -> bytes:
+        # Only our decompressed image is retained, not the FotaPayload itself,
+        # so that evicting it frees its memory.
+        return self.cached(
+            ("fota_decompressed", name),
+            lambda: FotaPayload(
+                self.get_raw(name), self.budget, self.events
+            ).decompressed,
+        )
+
+    def get_fota_segment(self, name: str, index: str) -> FotaSegment:
+        segments = self.get_fota_metadata(name).segments
+        if not index.isdigit() or int(index) >= len(segments):
+            raise FileNotFoundError(f"No segment {index} within {name}")
+        return segments[int(index)]
+
+    def get_fota_segments(self, name: str) -> list[bytes]:
+        # As with FotaPayload, each segment offset is 0x1000 ahead.
+        # Segments are views of our decompressed image.
+        decompressed = memoryview(self.get_fota_decompressed(name))
+        segments = []
+        for segment in self.get_fota_metadata(name).segments:
+            segment_offset_start = segment.payload_offset - 0x1000
+            segment_offset_end = segment_offset_start + segment.payload_length
+            segments.append(decompressed[segment_offset_start:segment_offset_end])
+        return segments
+
+    def get_rofs(self, name: str) -> ROFS:
+        # Our files are views of our decompressed image, which we count.
+        image_size = 0
+
+        def find_partition() -> ROFS:
+            nonlocal image_size
+            image_size = len(self.get_fota_decompressed(name))
+            return find_rofs(self.get_fota_segments(name))
+
+        return self.cached(("rofs", name), find_partition, lambda _: image_size)
+
+    def get_decompressed(self, name: str) -> bytes:
+        payload = self.get_payload(name)
+        chunk_size = payload.plist_metadata.compressed_chunk_size
+        return self.cached(
+            ("decompressed", name),
+            lambda: decompress_chunks(
+                self.get_raw(name), chunk_size, self.budget, self.events, name
+            ),
+        )
+
+    def get_decompressed_size(self, name: str) -> int:
+        # Our final chunk specifies where our decompressed contents end.
+        chunk_size = self.get_payload(name).plist_metadata.compressed_chunk_size
+        last_chunk = read_chunks(self.get_raw(name), chunk_size)[-1]
+        return last_chunk.decompressed_offset + last_chunk.decompressed_length
+
+    @staticmethod
+    def split(path: str) -> list[str]:
+        return [component for component in path.split("/") if component not in ["", "."]]
+
+    def listdir(self, path: str = "") -> list[str]:
+        """Lists the entries within the given directory."""
+        components = self.split(path)
+        if not components:
+            return ["SuperBinary.plist", *self.payloads.keys()]
+
+        name, *rest = components
+        payload = self.get_payload(name)
+        if not rest:
+            entries = ["raw"]
+            if self.is_fota(name):
+                entries += ["compressed", "decompressed", "segments", "rofs"]
+            elif payload.plist_metadata.compressed_chunk_size:
+                entries.append("decompressed")
+            return entries
+
+        if self.is_fota(name) and len(rest) == 1:
+            if rest[0] == "segments":
+                segments = self.get_fota_metadata(name).segments
+                return [str(index) for index in range(len(segments))]
+            if rest[0] == "rofs":
+                return [file.file_name for file in self.get_rofs(name).files]
+
+        # Otherwise, we're a file, or do not exist.
+        self.stat(path)
+        raise NotADirectoryError(path)
+
+    def stat(self, path: str) -> VirtualStat:
+        """Returns information about the given path.
+        Where possible, sizes are determined without decompressing."""
+        components = self.split(path)
+        if not components:
+            return VirtualStat(True, len(self.payloads) + 1)
+        if components == ["SuperBinary.plist"]:
+            return VirtualStat(False, len(self.super_binary.raw_plist_data))
+
+        name, *rest = components
+        payload = self.get_payload(name)
+        if not rest or (self.is_fota(name) and rest in [["segments"], ["rofs"]]):
+            return VirtualStat(True, len(self.listdir(path)))
+
+        if rest == ["raw"]:
+            return VirtualStat(False, payload.payloads_length)
+        if rest == ["decompressed"] and self.is_fota(name):
+            # Our LZMA header alone declares our size.
+            lzma_header = self.read_prefix(name, 0x1000 + 13)[0x1000:]
+            declared_size = get_lzma_declared_size(lzma_header)
+            if declared_size is None:
+                declared_size = len(self.get_fota_decompressed(name))
+            return VirtualStat(False, declared_size)
+        if rest == ["decompressed"] and payload.plist_metadata.compressed_chunk_size:
+            return VirtualStat(False, self.get_decompressed_size(name))
+        if self.is_fota(name) and len(rest) == 2 and rest[0] == "segments":
+            segment = self.get_fota_segment(name, rest[1])
+            return VirtualStat(False, segment.payload_length)
+
+        return VirtualStat(False, len(self.read(path)))
+
+    def read(self, path: str) -> bytes:
+        """Returns the contents of the given file, resolving layers as necessary."""
+        components = self.split(path)
+        if components == ["SuperBinary.plist"]:
+            return self.super_binary.raw_plist_data
+        if not components:
+            raise IsADirectoryError(path)
+
+        name, *rest = components
+        payload = self.get_payload(name)
+        if rest == ["raw"]:
+            return self.get_raw(name)
+
+        if self.is_fota(name):
+            if rest == ["compressed"]:
+                return memoryview(self.get_raw(name))[0x1000:]
+            if rest == ["decompressed"]:
+                return self.get_fota_decompressed(name)
+            if len(rest) == 2 and rest[0] == "segments":
+                self.get_fota_segment(name, rest[1])
+                return self.get_fota_segments(name)[int(rest[1])]
+            if len(rest) == 2 and rest[0] == "rofs":
+                for file in self.get_rofs(name).files:
+                    if file.file_name == rest[1]:
+                        return file.contents
+                raise FileNotFoundError(f"No file {rest[1]} within ROFS of {name}")
+            if rest in [["segments"], ["rofs"]]:
+                raise IsADirectoryError(path)
+        elif rest == ["decompressed"] and payload.plist_metadata.compressed_chunk_size:
+            return self.get_decompressed(name)
+
+        if not rest:
+            raise IsADirectoryError(path)
+        raise FileNotFoundError(path)
+
+    def open(self, path: str) -> BinaryIO:
+        """Opens the given file for reading."""
+        return BufferReader(self.read(path))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Lists and reads paths within a SuperBinary without a full extraction."
+    )
+    parser.add_argument(
+        "source",
+        help='Path to the SuperBinary, or "-" for standard input.',
+    )
+    parser.add_argument(
+        "command",
+        choices=["ls", "stat", "cat"],
+        help="Whether to list a directory, describe a path, or write a file to standard output.",
+    )
+    parser.add_argument("path", nargs="?", default="", help="i.e. FOTA/rofs/file.wav")
+    parser.add_argument(
+        "--member",
+        help="If the source is a zip or tar archive, the name of the SuperBinary within it.",
+    )
+    parser.add_argument(
+        "--max-memory",
+        help="A memory budget (i.e. 512M) shared by all buffers. Buffers exceeding it are spilled to temporary files.",
+        type=parse_size,
+    )
+    args = parser.parse_args()
+
+    budget = MemoryBudget(args.max_memory) if args.max_memory else None
+    fs = VirtualFS(open_source(args.source, args.member, budget), budget)
+    if args.command == "ls":
+        for entry in fs.listdir(args.path):
+            print(entry)
+    elif args.command == "stat":
+        stat = fs.stat(args.path)
+        print(f"{'directory' if stat.is_dir else 'file'}, {stat.size}")
+    else:
+        sys.stdout.buffer.write(fs.read(args.path))